@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Compares time-to-first-audio-packet of the ffmpeg PCM path against the
+# pre-encoded opus cache. Run from the repo root with
+# `python -m benchmarks.bench_opus_playback -file path/to/sound.mp3`
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import discord
+
+from bot.opus_cache import OpusCache
+
+
+def _time_first_packet(create_source):
+    start = time.perf_counter()
+    source = create_source()
+    packet = source.read()
+    elapsed = time.perf_counter() - start
+    source.cleanup()
+
+    if not packet:
+        raise Exception('Source returned no audio')
+
+    return elapsed
+
+
+def _report(label, timings):
+    print(f'{label}: median {statistics.median(timings) * 1000:.1f}ms, max {max(timings) * 1000:.1f}ms')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('''Benchmark time to first audio packet''')
+    parser.add_argument('-file', type=str, help='The audio file to play', required=True)
+    parser.add_argument('-runs', type=int, help='Number of plays to time', default=20)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        source_path = os.path.join(tmp_dir, os.path.split(args.file)[-1])
+        shutil.copyfile(args.file, source_path)
+
+        opus_cache = OpusCache()
+        opus_cache._transcode(source_path)
+
+        if not opus_cache.is_cached(source_path):
+            raise Exception(f'Unable to transcode {source_path}')
+
+        ffmpeg_timings = [_time_first_packet(lambda: discord.FFmpegPCMAudio(source_path)) for _ in range(args.runs)]
+        opus_timings = [_time_first_packet(lambda: opus_cache.open_source(source_path)) for _ in range(args.runs)]
+
+        _report('FFmpegPCMAudio', ffmpeg_timings)
+        _report('Opus cache', opus_timings)
+        opus_cache.close()
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Measures end to end StreetView.create_img_grid time, output size and event
+# loop stalls against a local fake Street View image endpoint. Run from the
+# repo root with `python -m benchmarks.bench_street_view_grid`
+
+import time
+import asyncio
+import argparse
+import threading
+import statistics
+import httpx
+import numpy as np
+
+from io import BytesIO
+from PIL import Image
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cogs.maps.location as location
+from cogs.maps.location import Location
+from cogs.maps.street_view import StreetView, IMG_BORDER, IMG_WIDTH, IMG_HEIGHT, GRID_FORMATS
+
+BENCH_PORT = 8768
+
+
+def _create_tile():
+    # Smooth gradients with some noise compress roughly like a photo does
+    y, x = np.mgrid[0:IMG_HEIGHT, 0:IMG_WIDTH]
+    base = np.stack([x * 255 / IMG_WIDTH, y * 255 / IMG_HEIGHT, (x + y) * 127 / IMG_WIDTH], axis=-1)
+    noise = np.random.normal(0, 20, base.shape)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    tile = BytesIO()
+    Image.fromarray(pixels, 'RGB').save(tile, format='jpeg', quality=90)
+    return tile.getvalue()
+
+
+class FakeImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    handshake = 0.05
+    latency = 0.15
+    tile = b''
+
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.handshake)
+
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.tile)))
+        self.end_headers()
+        self.wfile.write(self.tile)
+
+
+async def _sequential_grid(street_view, loc):
+    # The old behaviour, one tile at a time with a new client each and the
+    # grid composed and encoded on the event loop
+    img = Image.new('RGB', ((IMG_BORDER * 3) + (IMG_WIDTH * 2), (IMG_BORDER * 3) + (IMG_HEIGHT * 2)), (255, 255, 255))
+
+    for i in range(4):
+        async with httpx.AsyncClient() as client:
+            resp = await client.get(Location(loc.lat, loc.lng, 90 * i).street_view_img_url(street_view.api_token))
+
+        img.paste(Image.open(BytesIO(resp.content)), (IMG_BORDER + (i % 2) * (IMG_WIDTH + IMG_BORDER), IMG_BORDER + (i // 2) * (IMG_HEIGHT + IMG_BORDER)))
+
+    full_img_bytes = BytesIO()
+    img.save(full_img_bytes, format='png')
+    full_img_bytes.seek(0)
+    return full_img_bytes
+
+
+async def _measure_loop_lag(stop, lags):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - start - 0.005)
+
+
+async def _run(street_view, create_grid, rounds):
+    stop = asyncio.Event()
+    lags = []
+    lag_task = asyncio.ensure_future(_measure_loop_lag(stop, lags))
+    times = []
+    size = 0
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        grid = await create_grid(street_view, Location(51.5, -0.1))
+        times.append(time.perf_counter() - start)
+        size = len(grid.getvalue())
+
+    stop.set()
+    await lag_task
+    await street_view.close()
+    return times, size, max(lags or [0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('''Benchmark street view grid creation''')
+    parser.add_argument('-rounds', type=int, help='Number of grids per strategy', default=10)
+    parser.add_argument('-handshake', type=float, help='Seconds added to every new connection', default=0.05)
+    parser.add_argument('-latency', type=float, help='Seconds added to every tile request', default=0.15)
+    parser.add_argument('-quality', type=int, help='JPEG/WebP quality', default=85)
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    FakeImageHandler.tile = _create_tile()
+    FakeImageHandler.handshake = args.handshake
+    FakeImageHandler.latency = args.latency
+    location.STREET_VIEW_API_URL = f'http://127.0.0.1:{BENCH_PORT}/streetview?location={{0}},{{1}}&heading={{2}}&key={{3}}'
+
+    server = ThreadingHTTPServer(('127.0.0.1', BENCH_PORT), FakeImageHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    strategies = [('sequential, png on the loop', StreetView('', 'key'), _sequential_grid)]
+    strategies += [(f'parallel, {f} in executor', StreetView('', 'key', grid_format=f, grid_quality=args.quality), StreetView.create_img_grid) for f in GRID_FORMATS]
+
+    for name, street_view, create_grid in strategies:
+        times, size, max_lag = asyncio.run(_run(street_view, create_grid, args.rounds))
+        print(f'{name}: median {statistics.median(times) * 1000:.0f}ms, max {max(times) * 1000:.0f}ms, {size / 1024:.0f}KB, max loop stall {max_lag * 1000:.0f}ms')
+
+    server.shutdown()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Measures how long StreetView takes to find a location with coverage against
+# a local fake metadata endpoint. Each new connection pays a handshake delay
+# and each request pays a round trip delay. Run from the repo root with
+# `python -m benchmarks.bench_street_view_probe`
+
+import time
+import json
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+import httpx
+import numpy as np
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cogs.maps.location as location
+from cogs.maps.location import Location
+from cogs.maps.street_view import StreetView
+
+BENCH_PORT = 8767
+
+
+class FakeMetaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    hit_rate = 0.02
+    handshake = 0.05
+    latency = 0.03
+    requests = 0
+
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.handshake)
+
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+        FakeMetaHandler.requests += 1
+        time.sleep(self.latency)
+
+        if random.random() < self.hit_rate:
+            body = {'status': 'OK', 'location': {'lat': 51.5, 'lng': -0.1}}
+        else:
+            body = {'status': 'ZERO_RESULTS'}
+
+        data = json.dumps(body).encode('utf-8')
+
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The rest of a wave is cancelled once one probe hits
+            pass
+
+
+class FreshClientStreetView(StreetView):
+    # The old behaviour, a brand new client and connection for every probe
+    async def check_for_street_view_img(self, loc):
+        async with httpx.AsyncClient() as client:
+            resp = await client.get(loc.street_view_meta_url(self.api_token))
+            resp_json = resp.json()
+
+            if resp_json['status'].lower() == 'ok':
+                return Location(lat=resp_json['location']['lat'], lng=resp_json['location']['lng'])
+
+
+async def _run(street_view, rounds):
+    times = []
+    requests = []
+
+    for _ in range(rounds):
+        FakeMetaHandler.requests = 0
+        start = time.perf_counter()
+        await street_view.find_random_street_view_loc(starting_loc=Location(51.5, -0.1), radius=10)
+        times.append(time.perf_counter() - start)
+        requests.append(FakeMetaHandler.requests)
+
+    await street_view.close()
+    return times, requests
+
+
+def _report(name, times, requests):
+    times = sorted(times)
+    p90 = times[int(len(times) * 0.9) - 1]
+    print(f'{name}: median {statistics.median(times) * 1000:.0f}ms, p90 {p90 * 1000:.0f}ms, {statistics.mean(requests):.1f} requests per search')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('''Benchmark street view coverage probing''')
+    parser.add_argument('-rounds', type=int, help='Number of searches per strategy', default=20)
+    parser.add_argument('-hit_rate', type=float, help='Chance a random point has coverage', default=0.02)
+    parser.add_argument('-handshake', type=float, help='Seconds added to every new connection', default=0.05)
+    parser.add_argument('-latency', type=float, help='Seconds added to every request', default=0.03)
+    parser.add_argument('-wave_sizes', type=int, nargs='+', help='Wave sizes to compare', default=[5, 10, 20])
+    args = parser.parse_args()
+
+    FakeMetaHandler.hit_rate = args.hit_rate
+    FakeMetaHandler.handshake = args.handshake
+    FakeMetaHandler.latency = args.latency
+    location.STREET_META_API_URL = f'http://127.0.0.1:{BENCH_PORT}/metadata?location={{0}},{{1}}&heading={{2}}&key={{3}}'
+
+    server = ThreadingHTTPServer(('127.0.0.1', BENCH_PORT), FakeMetaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    strategies = [('sequential, new client per probe', lambda: FreshClientStreetView('', 'key', probe_wave_size=1))]
+    strategies += [(f'waves of {n}, pooled client', lambda n=n: StreetView('', 'key', probe_wave_size=n)) for n in args.wave_sizes]
+
+    for name, create in strategies:
+        random.seed(0)
+        np.random.seed(0)
+        times, requests = asyncio.run(_run(create(), args.rounds))
+        _report(name, times, requests)
+
+    server.shutdown()
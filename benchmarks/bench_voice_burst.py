@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Simulates a raid of users joining a voice channel and counts how many audio
+# decoders each play policy spawns. Run from the repo root with
+# `python -m benchmarks.bench_voice_burst`
+
+import time
+import random
+import asyncio
+import argparse
+import threading
+
+from bot.voice import Voice, VoiceSession, PlayPolicy, PRIORITY_COMMAND, PRIORITY_ENTRANCE, COALESCE_LATEST, COALESCE_QUEUE
+
+
+class FakeVoiceClient:
+    def __init__(self, channel, sound_length):
+        self.channel = channel
+        self.sound_length = sound_length
+        self._timer = None
+        self._after = None
+
+
+    def is_connected(self):
+        return True
+
+
+    def is_playing(self):
+        return self._timer is not None and self._timer.is_alive()
+
+
+    def play(self, source, after):
+        self._after = after
+        self._timer = threading.Timer(self.sound_length, self._finish)
+        self._timer.start()
+
+
+    def stop(self):
+        if self.is_playing():
+            self._timer.cancel()
+            self._finish()
+
+
+    def _finish(self):
+        after, self._after = self._after, None
+
+        if after:
+            after(None)
+
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+
+    async def disconnect(self):
+        self.stop()
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, guild, sound_length):
+        self.guild = guild
+        self.name = 'General'
+        self.sound_length = sound_length
+
+
+    async def connect(self):
+        return FakeVoiceClient(self, self.sound_length)
+
+
+def _create_source(session, file_path):
+    session.manager.stats['decoders'] += 1
+    return object()
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+
+
+    def dispatch(self, event, *args):
+        pass
+
+
+    async def change_presence(self, **kwargs):
+        pass
+
+
+async def _run_burst(policy, joins, join_gap, sound_length):
+    bot = FakeBot(asyncio.get_event_loop())
+    voice = Voice(bot, idle_timeout=0, policy=policy)
+    channel = FakeChannel(FakeGuild(1), sound_length)
+
+    for i in range(joins):
+        await voice.play(channel, f'entrance_{i}.mp3', f'entrance_{i}', priority=PRIORITY_ENTRANCE)
+        await asyncio.sleep(random.uniform(0, join_gap))
+
+    await voice.play(channel, 'command.mp3', 'command', priority=PRIORITY_COMMAND)
+
+    session = voice.get_session(1)
+
+    while session.queue or session._is_busy():
+        await asyncio.sleep(0.05)
+
+    return voice.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('''Benchmark decoder spawns during an entrance burst''')
+    parser.add_argument('-joins', type=int, help='Number of users joining', default=30)
+    parser.add_argument('-join_gap', type=float, help='Maximum seconds between joins', default=0.1)
+    parser.add_argument('-sound_length', type=float, help='Length of each entrance sound in seconds', default=0.5)
+    args = parser.parse_args()
+
+    VoiceSession._create_file_source = _create_source
+
+    policies = {
+        'restart every join': PlayPolicy(coalesce_window=0, coalesce_mode=COALESCE_QUEUE, coalesce_max=args.joins, preempt_rules={
+            PRIORITY_COMMAND: {PRIORITY_COMMAND, PRIORITY_ENTRANCE},
+            PRIORITY_ENTRANCE: {PRIORITY_ENTRANCE}
+        }),
+        'coalesce latest': PlayPolicy(coalesce_mode=COALESCE_LATEST),
+        'coalesce queue of 3': PlayPolicy(coalesce_mode=COALESCE_QUEUE, coalesce_max=3)
+    }
+
+    for name, policy in policies.items():
+        random.seed(0)
+        start = time.perf_counter()
+        stats = asyncio.get_event_loop().run_until_complete(_run_burst(policy, args.joins, args.join_gap, args.sound_length))
+        print(f'{name}: {stats["decoders"]} decoders, {stats["coalesced"]} coalesced, {stats["preempted"]} preempted ({time.perf_counter() - start:.2f}s)')
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Compares the old guild/channel/member scan against the voice state index for
+# user to voice channel lookups. Run from the repo root with
+# `python -m benchmarks.bench_voice_index`
+
+import time
+import random
+import argparse
+
+from types import SimpleNamespace
+from bot.voice_index import VoiceStateIndex
+
+
+def _scan(guilds, user_id):
+    for g in guilds:
+        for c in g.voice_channels:
+            for m in c.members:
+                if m.id == user_id:
+                    return c
+
+
+def _create_guilds(guild_count, channel_count, member_count):
+    guilds = []
+    user_id = 0
+
+    for g in range(guild_count):
+        channels = []
+
+        for c in range(channel_count):
+            members = []
+
+            for _ in range(member_count):
+                members.append(SimpleNamespace(id=user_id))
+                user_id += 1
+
+            channels.append(SimpleNamespace(name=f'{g}-{c}', members=members))
+
+        guilds.append(SimpleNamespace(voice_channels=channels))
+
+    return guilds, user_id
+
+
+def _time_lookups(label, lookup, user_ids):
+    start = time.perf_counter()
+
+    for user_id in user_ids:
+        lookup(user_id)
+
+    elapsed = time.perf_counter() - start
+    print(f'{label}: {elapsed / len(user_ids) * 1000000:.2f}us per lookup')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('''Benchmark user to voice channel lookups''')
+    parser.add_argument('-guilds', type=int, help='Number of guilds', default=200)
+    parser.add_argument('-channels', type=int, help='Voice channels per guild', default=10)
+    parser.add_argument('-members', type=int, help='Members in each voice channel', default=20)
+    parser.add_argument('-lookups', type=int, help='Number of lookups to time', default=2000)
+    args = parser.parse_args()
+
+    guilds, user_count = _create_guilds(args.guilds, args.channels, args.members)
+    user_ids = [random.randrange(user_count) for _ in range(args.lookups)]
+
+    index = VoiceStateIndex()
+    start = time.perf_counter()
+    index.rebuild(guilds)
+    print(f'Indexed {len(index)} users in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    _time_lookups('Scan', lambda u: _scan(guilds, u), user_ids)
+    _time_lookups('Index', index.get_channel, user_ids)
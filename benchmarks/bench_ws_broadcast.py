@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Load tests the websocket now playing broadcast with hundreds of local
+# subscribers, some of which never read. Run from the repo root with
+# `python -m benchmarks.bench_ws_broadcast`
+
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import websockets
+
+from types import SimpleNamespace
+from bot.ws_server import WSServer
+
+WS_BENCH_PORT = 8766
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.voice = SimpleNamespace(sessions={})
+
+
+    def add_listener(self, func, name):
+        pass
+
+
+class FakeRepo:
+    def add_listener(self, callback):
+        pass
+
+
+async def _fast_client(done, final_title, received):
+    async with websockets.connect(f'ws://127.0.0.1:{WS_BENCH_PORT}', max_queue=None) as ws:
+        await ws.send(json.dumps({'id': 1, 'action': 'subscribe'}))
+        await ws.recv()
+        done.release()
+
+        async for msg in ws:
+            received[0] += 1
+            event = json.loads(msg)
+
+            if event['action'] == 'now_playing' and event['msg']['title'] == final_title:
+                return time.perf_counter()
+
+
+async def _slow_client(done, stop):
+    ws = await websockets.connect(f'ws://127.0.0.1:{WS_BENCH_PORT}', max_queue=1)
+    await ws.send(json.dumps({'id': 1, 'action': 'subscribe'}))
+    await ws.recv()
+    done.release()
+
+    # Never read again so the server side send buffer fills up
+    await stop.wait()
+    ws.transport.abort()
+
+
+async def _measure_loop_lag(stop, lags):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - start - 0.01)
+
+
+async def _run(clients, slow_clients, events, guilds, payload_size):
+    loop = asyncio.get_event_loop()
+    server = WSServer(FakeBot(loop), FakeRepo())
+
+    async with websockets.serve(server.serve, '127.0.0.1', WS_BENCH_PORT):
+        ready = asyncio.Semaphore(0)
+        stop = asyncio.Event()
+        final_title = f'final-{events}'
+        received = [0]
+
+        fast = [asyncio.ensure_future(_fast_client(ready, final_title, received)) for _ in range(clients - slow_clients)]
+        slow = [asyncio.ensure_future(_slow_client(ready, stop)) for _ in range(slow_clients)]
+
+        for _ in range(clients):
+            await ready.acquire()
+
+        lags = []
+        lag_task = asyncio.ensure_future(_measure_loop_lag(stop, lags))
+        padding = 'x' * payload_size
+        broadcast_times = []
+        start = time.perf_counter()
+
+        for i in range(events):
+            guild_id = i % guilds
+            t = time.perf_counter()
+            server.broadcast(f'now_playing:{guild_id}', 'now_playing', {'guild_id': guild_id, 'title': f'sound-{i}', 'padding': padding})
+            server.broadcast(f'queue:{guild_id}', 'queue', {'guild_id': guild_id, 'queue': [padding]})
+            broadcast_times.append(time.perf_counter() - t)
+
+            if i % 50 == 0:
+                await asyncio.sleep(0)
+
+        server.broadcast('now_playing:final', 'now_playing', {'guild_id': 'final', 'title': final_title})
+        finished = await asyncio.gather(*fast)
+        delivery = [f - start for f in finished]
+        merged = sum(s.merged for s in server.subscribers.values())
+        dropped = sum(s.dropped for s in server.subscribers.values())
+
+        stop.set()
+        await lag_task
+        await asyncio.gather(*slow)
+
+        print(f'{clients} clients ({slow_clients} never reading), {events * 2} events')
+        print(f'Broadcast call: median {statistics.median(broadcast_times) * 1000:.3f}ms, max {max(broadcast_times) * 1000:.3f}ms')
+        print(f'Final event delivered to all readers in {max(delivery) * 1000:.0f}ms (median {statistics.median(delivery) * 1000:.0f}ms)')
+        print(f'Event loop lag (clients share the loop): max {max(lags or [0]) * 1000:.1f}ms')
+        print(f'Messages received by readers: {received[0]}, merged {merged}, dropped {dropped}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('''Load test the websocket broadcast''')
+    parser.add_argument('-clients', type=int, help='Number of subscribed clients', default=300)
+    parser.add_argument('-slow_clients', type=int, help='Number of clients that never read', default=30)
+    parser.add_argument('-events', type=int, help='Number of now playing changes to broadcast', default=500)
+    parser.add_argument('-guilds', type=int, help='Number of guilds the events are spread over', default=5)
+    parser.add_argument('-payload_size', type=int, help='Padding bytes added to each event', default=2048)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(_run(args.clients, args.slow_clients, args.events, args.guilds, args.payload_size))
@@ -1,51 +1,121 @@
+import time
+import asyncio
+
 from discord.ext.commands import Bot
 from discord.utils import get
 from discord.channel import DMChannel
 from discord import Intents
 
-from bot.voice import Voice
+from bot.voice import Voice, VOICE_IDLE_TIMEOUT, WARM_IDLE_TIMEOUT
+from bot.voice_index import VoiceStateIndex
 from bot.ws_server import WSServer
 from utils.users import BotUser
 
 
 class BotClient(Bot):
-    def __init__(self, user_manager, command_prefix='!'):
+    def __init__(self, user_manager, sound_files, opus_cache=None, url_cache=None, warm_voice=False, voice_idle_timeout=VOICE_IDLE_TIMEOUT,
+                 warm_idle_timeout=WARM_IDLE_TIMEOUT, command_prefix='!'):
         intents = Intents.default()
         intents.members = True
         super().__init__(command_prefix=command_prefix, intents=intents)
 
-        self.voice = Voice(self)
+        self.voice = Voice(
+            self,
+            opus_cache=opus_cache,
+            url_cache=url_cache,
+            idle_timeout=voice_idle_timeout,
+            warm_idle_timeout=warm_idle_timeout,
+            warm=warm_voice
+        )
+        self.voice_index = VoiceStateIndex()
         self.user_manager = user_manager
-        self.ws_server = WSServer(self)
+        self.ws_server = WSServer(self, sound_files)
+        self._sync_lock = asyncio.Lock()
+
+
+    async def start(self, *args, **kwargs):
+        print('Starting websocket server...')
+        await self.ws_server.start()
+        await super().start(*args, **kwargs)
 
 
     async def on_ready(self):
-        print('Looking for new users...')
+        self.voice_index.rebuild(self.guilds)
 
-        for g in self.guilds:
-            await g.chunk()
+        # on_ready fires again after gateway reconnects, don't stack syncs
+        if self._sync_lock.locked():
+            return
+
+        async with self._sync_lock:
+            await self._sync_users()
+
+        print('Jeff bot is loaded and ready to go!')
+
+
+    async def _sync_users(self):
+        print('Syncing users...')
+        timings = {}
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            self.user_manager.load(),
+            *[g.chunk() for g in self.guilds]
+        )
+        timings['fetch'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new_users, renamed_users = self._diff_members()
+        timings['diff'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        failed_users = await self.user_manager.sync_users(
+            new_users=new_users,
+            updated_users=renamed_users,
+            reload=False
+        )
+        timings['send'] = time.perf_counter() - start
 
-            new_users = []
+        start = time.perf_counter()
+        await self.user_manager.load()
+        timings['reload'] = time.perf_counter() - start
+
+        phases = ', '.join(f'{k} {v:.2f}s' for k, v in timings.items())
+        print(f'User sync complete - {len(new_users)} new, {len(renamed_users)} renamed, {len(failed_users)} failed ({phases})')
+
+
+    def _diff_members(self):
+        new_users = {}
+        renamed_users = {}
+
+        for g in self.guilds:
             for m in g.members:
-                if self.user.id == m.id:
+                if self.user.id == m.id or m.id in new_users or m.id in renamed_users:
                     continue
 
-                user = self.user_manager.get_user(m.id)
+                user = self.user_manager.get_cached_user(m.id)
 
-                if user:
-                    user.user_name = m.name
-                else:
-                    new_users.append(BotUser(
+                if not user:
+                    new_users[m.id] = BotUser(
                         user_id=m.id,
                         user_name=m.name
-                    ))
+                    )
+                elif user.user_name != m.name:
+                    renamed_users[m.id] = BotUser(
+                        user_id=user.user_id,
+                        user_name=m.name,
+                        entrance_filename=user.entrance_filename
+                    )
 
-            self.user_manager.add_users(new_users)
+        return list(new_users.values()), list(renamed_users.values())
 
-        print('Starting websocket server...')
-        self.ws_server.start(event_loop=self.loop)
 
-        print('Jeff bot is loaded and ready to go!')
+    async def on_resumed(self):
+        self.voice_index.rebuild(self.guilds)
+
+
+    async def on_voice_state_update(self, member, before, after):
+        self.voice_index.update(member, before, after)
+        self.voice.on_voice_state_update(member, before, after)
 
 
     async def on_message(self, message):
@@ -56,4 +126,16 @@ class BotClient(Bot):
 
 
     async def on_member_join(self, member):
-        self.user_manager.add_user(member.id, member.name, member.nick)
\ No newline at end of file
+        await self.user_manager.add_user(member.id, member.name)
+
+
+    async def close(self):
+        await self.ws_server.stop()
+        await self.user_manager.close()
+
+        if self.voice.opus_cache:
+            self.voice.opus_cache.close()
+
+        self.voice.url_cache.close()
+
+        await super().close()
\ No newline at end of file
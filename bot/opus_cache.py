@@ -0,0 +1,138 @@
+import os
+import threading
+import subprocess
+import discord
+
+from discord.oggparse import OggStream
+from concurrent.futures import ThreadPoolExecutor
+
+OPUS_CACHE_DIR = '.opus'
+OPUS_EXTENSION = 'opus'
+TRANSCODE_WORKERS = 2
+FFMPEG_TRANSCODE_ARGS = [
+    '-vn', '-map_metadata', '-1',
+    '-c:a', 'libopus', '-ar', '48000', '-ac', '2', '-b:a', '128k',
+    '-f', 'opus', '-loglevel', 'warning'
+]
+
+
+class OpusFileAudio(discord.AudioSource):
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._packets = OggStream(self._file).iter_packets()
+
+
+    def read(self):
+        return next(self._packets, b'')
+
+
+    def is_opus(self):
+        return True
+
+
+    def cleanup(self):
+        self._file.close()
+
+
+class OpusCache:
+    def __init__(self, workers=TRANSCODE_WORKERS, ffmpeg='ffmpeg'):
+        self.ffmpeg = ffmpeg
+        self.transcoded = 0
+        self.failed = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+
+    def cached_path(self, source_path):
+        head, tail = os.path.split(source_path)
+        name = os.path.splitext(tail)[0]
+        return os.path.join(head, OPUS_CACHE_DIR, f'{name}.{OPUS_EXTENSION}')
+
+
+    def is_cached(self, source_path):
+        cached_path = self.cached_path(source_path)
+
+        try:
+            return os.path.getmtime(cached_path) >= os.path.getmtime(source_path)
+        except OSError:
+            return False
+
+
+    def open_source(self, source_path):
+        if not self.is_cached(source_path):
+            self.queue(source_path)
+            return None
+
+        return OpusFileAudio(self.cached_path(source_path))
+
+
+    def watch(self, file_repo):
+        if not file_repo.base_path:
+            print('Opus cache only supports file repos with a local base path')
+            return
+
+        def on_change(event, file_obj):
+            if event == 'sync':
+                self.sync(file_repo)
+            elif event == 'add':
+                self.queue(file_obj.path)
+            elif event == 'delete':
+                self.remove(file_obj.path)
+
+        file_repo.add_listener(on_change)
+        self.sync(file_repo)
+
+
+    def sync(self, file_repo):
+        for f in file_repo.list_files():
+            if not self.is_cached(f.path):
+                self.queue(f.path)
+
+
+    def queue(self, source_path):
+        with self._lock:
+            if source_path in self._pending:
+                return
+
+            self._pending.add(source_path)
+
+        self._executor.submit(self._transcode, source_path)
+
+
+    def remove(self, source_path):
+        cached_path = self.cached_path(source_path)
+
+        if os.path.exists(cached_path):
+            os.remove(cached_path)
+
+
+    def _transcode(self, source_path):
+        cached_path = self.cached_path(source_path)
+        tmp_path = f'{cached_path}.part'
+
+        try:
+            os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+
+            subprocess.run(
+                [self.ffmpeg, '-y', '-i', source_path, *FFMPEG_TRANSCODE_ARGS, tmp_path],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+
+            os.replace(tmp_path, cached_path)
+            self.transcoded += 1
+        except Exception as e:
+            self.failed += 1
+            print(f'Failed to transcode {source_path} to opus - {e}')
+
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            with self._lock:
+                self._pending.discard(source_path)
+
+
+    def close(self):
+        self._executor.shutdown(wait=False)
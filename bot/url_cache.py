@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import httpx
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+URL_CACHE_DIR = '.url_cache'
+URL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+URL_CACHE_INDEX = 'index.json'
+STREAM_CHUNK_SIZE = 64 * 1024
+URL_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+SIGNING_PARAMS = ('x-goog-', 'googleaccessid', 'expires', 'signature')
+
+
+class UrlCache:
+    def __init__(self, cache_dir=URL_CACHE_DIR, max_bytes=URL_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._client = httpx.Client(timeout=URL_TIMEOUT, follow_redirects=True)
+        self._index = self._load_index()
+
+
+    # Blocks until the response headers arrive, so call it from an executor.
+    # Returns the cached file path or a pipe that fills as the download streams
+    def open(self, url):
+        key = self._cache_key(url)
+
+        with self._lock:
+            entry = self._index.get(key)
+
+            if entry and os.path.isfile(self._entry_path(entry)):
+                entry['last_used'] = time.time()
+                self.hits += 1
+                threading.Thread(target=self._revalidate, args=(url, key, entry), daemon=True).start()
+                return self._entry_path(entry), False
+
+            self.misses += 1
+
+        response = self._client.send(self._client.build_request('GET', url), stream=True)
+
+        try:
+            response.raise_for_status()
+        except httpx.HTTPError:
+            response.close()
+            raise
+
+        read_fd, write_fd = os.pipe()
+        threading.Thread(target=self._stream, args=(response, key, write_fd), daemon=True).start()
+
+        return os.fdopen(read_fd, 'rb'), True
+
+
+    def _revalidate(self, url, key, entry):
+        etag = entry['etag']
+        headers = {}
+
+        if etag:
+            headers['If-None-Match'] = etag
+        elif entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self._client.send(self._client.build_request('GET', url, headers=headers), stream=True)
+
+            if response.status_code == 304:
+                response.close()
+                return
+
+            response.raise_for_status()
+
+            if etag and response.headers.get('etag') == etag:
+                response.close()
+                return
+
+            print(f'Cached copy of {key} is stale, refreshing')
+            self._stream(response, key, None)
+        except Exception as e:
+            print(f'Unable to revalidate {key} - {e}')
+
+
+    def _stream(self, response, key, write_fd):
+        etag = response.headers.get('etag')
+        filename = hashlib.sha1(f'{key}|{etag}'.encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, filename)
+        tmp_path = None
+        pipe = os.fdopen(write_fd, 'wb') if write_fd is not None else None
+        size = 0
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            # The same url can be downloading more than once, from a repeat
+            # play or a revalidation, so each download gets its own temp file
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+
+            with os.fdopen(tmp_fd, 'wb') as f:
+                for chunk in response.iter_bytes(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+
+                    if pipe:
+                        try:
+                            pipe.write(chunk)
+                            pipe.flush()
+                        except (BrokenPipeError, ValueError):
+                            # Playback was stopped, keep downloading so the
+                            # next play of this url comes from disk
+                            pipe = None
+
+            os.replace(tmp_path, path)
+            self._add_entry(key, etag, response.headers.get('last-modified'), filename, size)
+        except Exception as e:
+            print(f'Failed to stream {key} - {e}')
+
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            response.close()
+
+            if pipe:
+                try:
+                    pipe.close()
+                except BrokenPipeError:
+                    pass
+
+
+    def _add_entry(self, key, etag, last_modified, filename, size):
+        with self._lock:
+            old = self._index.get(key)
+
+            if old and old['filename'] != filename:
+                self._remove_file(old)
+
+            self._index[key] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'filename': filename,
+                'size': size,
+                'last_used': time.time()
+            }
+
+            self._evict()
+            self._save_index()
+
+
+    def _evict(self):
+        total = sum(e['size'] for e in self._index.values())
+
+        for key, entry in sorted(self._index.items(), key=lambda i: i[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+
+            self._remove_file(entry)
+            del self._index[key]
+            total -= entry['size']
+
+
+    def _remove_file(self, entry):
+        path = self._entry_path(entry)
+
+        if os.path.exists(path):
+            os.remove(path)
+
+
+    def _entry_path(self, entry):
+        return os.path.join(self.cache_dir, entry['filename'])
+
+
+    def _cache_key(self, url):
+        # Signed urls change on every signing, so key them on the object alone
+        parts = urlsplit(url)
+        query = [(k, v) for k, v in parse_qsl(parts.query) if not k.lower().startswith(SIGNING_PARAMS)]
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+
+    def _load_index(self):
+        index_path = os.path.join(self.cache_dir, URL_CACHE_INDEX)
+
+        if not os.path.isfile(index_path):
+            return {}
+
+        try:
+            with open(index_path) as f:
+                return json.load(f)
+        except ValueError:
+            print(f'Ignoring corrupt url cache index {index_path}')
+            return {}
+
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, URL_CACHE_INDEX)
+        tmp_path = f'{index_path}.part'
+
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+
+        os.replace(tmp_path, index_path)
+
+
+    def close(self):
+        self._client.close()
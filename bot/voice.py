@@ -1,36 +1,241 @@
 import os
+import time
+import heapq
+import itertools
 import discord
 import asyncio
 
 from discord.utils import get
+from bot.url_cache import UrlCache
 
 FFMPEG_OPTIONS = {'options': '-vn'}
+VOICE_IDLE_TIMEOUT = 300
+WARM_IDLE_TIMEOUT = 1800
+JOIN_LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.0, 5.0, float('inf')]
+PRIORITY_COMMAND = 0
+PRIORITY_ENTRANCE = 1
+COALESCE_WINDOW = 1.0
+COALESCE_LATEST = 'latest'
+COALESCE_QUEUE = 'queue'
+COALESCE_MAX = 3
 
-class Voice(object):
-    def __init__(self, bot):
-        self.bot = bot
+class PlayPolicy(object):
+    def __init__(self, coalesce_window=COALESCE_WINDOW, coalesce_mode=COALESCE_LATEST, coalesce_max=COALESCE_MAX, preempt_rules=None):
+        if coalesce_mode not in (COALESCE_LATEST, COALESCE_QUEUE):
+            raise Exception(f'Unknown coalesce mode {coalesce_mode}')
+
+        self.coalesce_window = coalesce_window
+        self.coalesce_mode = coalesce_mode
+        self.coalesce_max = 1 if coalesce_mode == COALESCE_LATEST else coalesce_max
+
+        # Maps an incoming priority to the priorities it is allowed to cut off,
+        # by default commands interrupt anything and entrances wait their turn
+        self.preempt_rules = preempt_rules if preempt_rules is not None else {
+            PRIORITY_COMMAND: {PRIORITY_COMMAND, PRIORITY_ENTRANCE},
+            PRIORITY_ENTRANCE: set()
+        }
+
+
+    def can_preempt(self, incoming, current):
+        return current in self.preempt_rules.get(incoming, set())
+
+
+class PlayRequest(object):
+    _counter = itertools.count()
+
+    def __init__(self, channel, source, title, priority, not_before, on_error=None):
+        self.channel = channel
+        self.source = source
+        self.title = title
+        self.priority = priority
+        self.not_before = not_before
+        self.on_error = on_error
+        self.seq = next(PlayRequest._counter)
+
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+    # Requests are played by the queue worker long after play() returned, so
+    # failures are handed back through on_error, a coroutine function taking
+    # the exception
+    def fail(self, loop, error):
+        print(f'Failed to play {self.source} in {self.channel.name} - {error}')
+
+        if self.on_error:
+            loop.create_task(self.on_error(error))
+
+
+class VoiceSession(object):
+    def __init__(self, manager, guild_id):
+        self.manager = manager
+        self.bot = manager.bot
+        self.guild_id = guild_id
         self.voice = None
         self.now_playing = None
+        self.queue = []
+        self._current = None
+        self._worker = None
+        self._changed = asyncio.Event()
+        self._join_lock = asyncio.Lock()
+        self._idle_task = None
+
+
+    def is_connected(self):
+        return self.voice is not None and self.voice.is_connected()
+
+
+    def is_in_channel(self, channel):
+        return self.is_connected() and self.voice.channel == channel
 
 
     async def join_voice_channel(self, channel):
-        if self.voice and self.voice.is_connected():
-            await self.voice.move_to(channel)
-        else:
-            self.voice = await channel.connect()
+        self._cancel_idle_disconnect()
 
+        async with self._join_lock:
+            if self.is_in_channel(channel):
+                self.manager.record_join(None)
+                return
 
-    async def play(self, channel, source, title, delay=0):
-        if source.startswith('http') or source.startswith('https'):
-            await self._play_url(channel, source, title, delay)
-        else:
-            await self._play_file(channel, source, title, delay)
+            start = time.perf_counter()
+
+            if self.is_connected():
+                await self.voice.move_to(channel)
+            else:
+                self.voice = await channel.connect()
+
+            self.manager.record_join(time.perf_counter() - start)
+
+
+    async def prejoin(self, channel):
+        # Entrances are queued straight after this is scheduled, so a queue of
+        # requests for this channel is expected. Only hold off when something
+        # is playing or a pending request needs the bot somewhere else
+        if self._is_busy() or self.is_in_channel(channel):
+            return
+
+        if any(r.channel != channel for r in self.queue):
+            return
+
+        try:
+            await self.join_voice_channel(channel)
+            self.manager.stats['prejoins'] += 1
+            self._schedule_idle_disconnect()
+        except Exception as e:
+            print(f'Unable to pre-join {channel.name} - {e}')
+
+
+    async def play(self, channel, source, title, delay=0, priority=PRIORITY_COMMAND, on_error=None):
+        policy = self.manager.policy
+        now = self.bot.loop.time()
+
+        if priority == PRIORITY_ENTRANCE:
+            delay = max(delay, policy.coalesce_window)
+            self._coalesce(policy.coalesce_max - 1)
 
-        print(f'Playing {source} in {channel.name}...')
+        heapq.heappush(self.queue, PlayRequest(channel, source, title, priority, now + delay, on_error))
+        self.manager.stats['queued'] += 1
+        self._queue_changed()
+        self._wake()
+
+        if not self._worker or self._worker.done():
+            self._worker = self.bot.loop.create_task(self._process_queue())
+
+        print(f'Queued {source} in {channel.name}...')
 
 
     async def stop(self):
-        self.voice.stop()
+        self.queue = []
+        self._current = None
+        self._queue_changed()
+
+        if self.is_connected():
+            self.voice.stop()
+
+        await self._set_now_playing()
+
+
+    def _coalesce(self, keep):
+        entrances = sorted((r for r in self.queue if r.priority == PRIORITY_ENTRANCE), key=lambda r: r.seq)
+        dropped = entrances[:max(len(entrances) - keep, 0)]
+
+        if not dropped:
+            return
+
+        self.queue = [r for r in self.queue if r not in dropped]
+        heapq.heapify(self.queue)
+        self.manager.stats['coalesced'] += len(dropped)
+
+
+    def _wake(self):
+        self._changed.set()
+
+
+    def _queue_changed(self):
+        self.bot.dispatch('voice_queue', self.guild_id, [r.title for r in sorted(self.queue)])
+
+
+    def _is_busy(self):
+        return self.is_connected() and self.voice.is_playing()
+
+
+    async def _wait_for_change(self, timeout):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+    async def _process_queue(self):
+        while self.queue:
+            self._changed.clear()
+            request = self.queue[0]
+            wait = request.not_before - self.bot.loop.time()
+
+            if wait > 0:
+                await self._wait_for_change(wait)
+                continue
+
+            if self._is_busy() and self._current:
+                if not self.manager.policy.can_preempt(request.priority, self._current.priority):
+                    await self._wait_for_change(None)
+                    continue
+
+                self.manager.stats['preempted'] += 1
+
+            heapq.heappop(self.queue)
+            self._queue_changed()
+
+            try:
+                await self._start(request)
+            except Exception as e:
+                request.fail(self.bot.loop, e)
+
+
+    async def _start(self, request):
+        self._current = request
+        await self.join_voice_channel(request.channel)
+        await self._set_now_playing(request.source, request.title)
+
+        if request.source.startswith('http') or request.source.startswith('https'):
+            source = await self._create_url_source(request.source)
+        else:
+            source = self._create_file_source(request.source)
+
+        self.manager.stats['played'] += 1
+        await self._voice_play(source, request)
+        print(f'Playing {request.source} in {request.channel.name}...')
+
+
+    async def disconnect(self):
+        self._cancel_idle_disconnect()
+
+        if self.is_connected():
+            print(f'Disconnecting from voice in guild {self.guild_id} - {self.manager.join_report()}')
+            await self.voice.disconnect()
+
+        self.voice = None
         await self._set_now_playing()
 
 
@@ -40,31 +245,184 @@ class Voice(object):
                 'source': source,
                 'title': title
             }
-            await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=title))
         else:
             self.now_playing = None
-            await self.bot.change_presence(status=discord.Status.idle)
 
+        self.bot.dispatch('now_playing', self.guild_id, self.now_playing)
+        await self.manager.update_presence(self)
+
+
+    def _create_file_source(self, file_path):
+        opus_cache = self.manager.opus_cache
+        source = opus_cache.open_source(file_path) if opus_cache else None
+
+        if not source:
+            self.manager.stats['decoders'] += 1
+            source = discord.FFmpegPCMAudio(file_path)
 
-    async def _play_file(self, channel, file_path, title, delay):
-        await self.join_voice_channel(channel)
-        await self._set_now_playing(file_path, title)
-        await asyncio.sleep(delay)
-        await self._voice_play(discord.FFmpegPCMAudio(file_path), title)
+        return source
 
 
-    async def _play_url(self, channel, url, title, delay):
-        await self.join_voice_channel(channel)
-        await self._set_now_playing(url, title)
-        import requests
-        r = requests.get(url, allow_redirects=True)
-        open(f'{title}.mp3', 'wb').write(r.content)
-        await asyncio.sleep(delay)
-        await self._voice_play(discord.FFmpegPCMAudio(url, **FFMPEG_OPTIONS), title)
+    async def _create_url_source(self, url):
+        source, is_stream = await self.bot.loop.run_in_executor(None, self.manager.url_cache.open, url)
+        self.manager.stats['decoders'] += 1
 
+        if not is_stream:
+            return discord.FFmpegPCMAudio(source, **FFMPEG_OPTIONS)
 
-    async def _voice_play(self, source, title):
+        # ffmpeg now holds its own copy of the pipe so ours can be closed
+        audio = discord.FFmpegPCMAudio(source, pipe=True, **FFMPEG_OPTIONS)
+        source.close()
+        return audio
+
+
+    async def _voice_play(self, source, request):
         if self.voice.is_playing():
             self.voice.stop()
 
-        self.voice.play(source)
\ No newline at end of file
+        self.voice.play(source, after=lambda error: self._on_play_finished(request, error))
+
+
+    # Called from the voice player thread
+    def _on_play_finished(self, request, error):
+        if error:
+            print(f'Voice playback failed in guild {self.guild_id} - {error}')
+            self.bot.loop.call_soon_threadsafe(request.fail, self.bot.loop, error)
+
+        self.bot.loop.call_soon_threadsafe(self._wake)
+        self.bot.loop.call_soon_threadsafe(self._schedule_idle_disconnect)
+
+
+    def _schedule_idle_disconnect(self):
+        self._cancel_idle_disconnect()
+        timeout = self._idle_timeout()
+
+        if timeout:
+            self._idle_task = self.bot.loop.create_task(self._idle_disconnect(timeout))
+
+
+    def _idle_timeout(self):
+        if self.manager.warm and self._has_listeners():
+            return self.manager.warm_idle_timeout
+
+        return self.manager.idle_timeout
+
+
+    def _has_listeners(self):
+        return self.is_connected() and any(not m.bot for m in self.voice.channel.members)
+
+
+    def _cancel_idle_disconnect(self):
+        if self._idle_task and not self._idle_task.done():
+            self._idle_task.cancel()
+
+        self._idle_task = None
+
+
+    async def _idle_disconnect(self, timeout):
+        await asyncio.sleep(timeout)
+
+        if self._is_busy() or self.queue:
+            return
+
+        self._idle_task = None
+        await self.disconnect()
+
+
+class Voice(object):
+    def __init__(self, bot, opus_cache=None, idle_timeout=VOICE_IDLE_TIMEOUT, policy=None, url_cache=None,
+                 warm=False, warm_idle_timeout=WARM_IDLE_TIMEOUT):
+        self.bot = bot
+        self.opus_cache = opus_cache
+        self.url_cache = url_cache or UrlCache()
+        self.idle_timeout = idle_timeout
+        self.warm = warm
+        self.warm_idle_timeout = warm_idle_timeout
+        self.policy = policy or PlayPolicy()
+        self.sessions = {}
+        self.join_latencies = {b: 0 for b in JOIN_LATENCY_BUCKETS}
+        self.stats = {
+            'queued': 0,
+            'played': 0,
+            'coalesced': 0,
+            'preempted': 0,
+            'decoders': 0,
+            'joins': 0,
+            'warm_joins': 0,
+            'prejoins': 0
+        }
+
+
+    def record_join(self, elapsed):
+        if elapsed is None:
+            self.stats['warm_joins'] += 1
+            return
+
+        self.stats['joins'] += 1
+        bucket = next(b for b in JOIN_LATENCY_BUCKETS if elapsed <= b)
+        self.join_latencies[bucket] += 1
+        print(f'Voice join took {elapsed:.2f}s')
+
+
+    def join_report(self):
+        buckets = ', '.join(f'<={b}s: {c}' for b, c in self.join_latencies.items() if c)
+        return f'{self.stats["joins"]} cold joins ({buckets or "none"}), {self.stats["warm_joins"]} warm, {self.stats["prejoins"]} pre-joins'
+
+
+    def get_session(self, guild_id):
+        if guild_id not in self.sessions:
+            self.sessions[guild_id] = VoiceSession(self, guild_id)
+
+        return self.sessions[guild_id]
+
+
+    def now_playing(self, guild_id):
+        session = self.sessions.get(guild_id)
+        return session.now_playing if session else None
+
+
+    async def play(self, channel, source, title, delay=0, priority=PRIORITY_COMMAND, on_error=None):
+        await self.get_session(channel.guild.id).play(channel, source, title, delay, priority, on_error)
+
+
+    def prejoin(self, channel):
+        if not self.warm:
+            return
+
+        self.bot.loop.create_task(self.get_session(channel.guild.id).prejoin(channel))
+
+
+    def on_voice_state_update(self, member, before, after):
+        if not self.warm or member.bot or not before.channel:
+            return
+
+        # Someone left, so let the session fall back to the shorter idle
+        # timeout if the bot's channel no longer has anyone listening
+        session = self.sessions.get(before.channel.guild.id)
+
+        if session and session.is_in_channel(before.channel) and not session._is_busy() and not session.queue:
+            session._schedule_idle_disconnect()
+
+
+    async def stop(self, guild_id):
+        session = self.sessions.get(guild_id)
+
+        if session:
+            await session.stop()
+
+
+    async def disconnect_all(self):
+        await asyncio.gather(*[s.disconnect() for s in self.sessions.values()])
+
+
+    async def update_presence(self, session):
+        if session.now_playing:
+            await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=session.now_playing['title']))
+            return
+
+        playing = next((s for s in self.sessions.values() if s.now_playing), None)
+
+        if playing:
+            await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=playing.now_playing['title']))
+        else:
+            await self.bot.change_presence(status=discord.Status.idle)
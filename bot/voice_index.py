@@ -0,0 +1,31 @@
+class VoiceStateIndex(object):
+    def __init__(self):
+        self._channels = {}
+
+
+    def rebuild(self, guilds):
+        channels = {}
+
+        for g in guilds:
+            for c in g.voice_channels:
+                for m in c.members:
+                    channels[m.id] = c
+
+        self._channels = channels
+
+
+    def update(self, member, before, after):
+        if after.channel:
+            self._channels[member.id] = after.channel
+        elif self._channels.get(member.id) == before.channel:
+            # Events from different guilds can arrive out of order, a late
+            # leave must not drop the channel the member has since joined
+            del self._channels[member.id]
+
+
+    def get_channel(self, user_id):
+        return self._channels.get(int(user_id))
+
+
+    def __len__(self):
+        return len(self._channels)
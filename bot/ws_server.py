@@ -1,49 +1,289 @@
 import websockets
+import asyncio
 import json
-import nest_asyncio
+
+from collections import OrderedDict
+
+from utils.discord_helpers import get_channel_from_user_id
 
 WS_PORT = 8765
+WS_MAX_CONCURRENT = 8
+WS_MAX_PENDING_EVENTS = 32
+
+# Required fields and their accepted types for each action
+REQUEST_SCHEMAS = {
+    'play': {'user_id': (str, int), 'filename': str},
+    'random': {'user_id': (str, int)},
+    'stop': {'user_id': (str, int)},
+    'list': {},
+    'subscribe': {},
+    'unsubscribe': {}
+}
+
+
+class WSError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class WSSubscriber(object):
+    def __init__(self, websocket, max_pending=WS_MAX_PENDING_EVENTS):
+        self.websocket = websocket
+        self.max_pending = max_pending
+        self.merged = 0
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+
+    def push(self, key, event):
+        # A newer event replaces an unsent one with the same key, and the
+        # oldest event is dropped if a slow client lets too many build up
+        if key in self._pending:
+            del self._pending[key]
+            self.merged += 1
+        elif len(self._pending) >= self.max_pending:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+
+        self._pending[key] = event
+        self._ready.set()
+
+
+    async def _run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+
+                while self._pending:
+                    _, event = self._pending.popitem(last=False)
+                    await self.websocket.send(event)
+        except websockets.ConnectionClosed:
+            pass
+
+
+    def close(self):
+        self._task.cancel()
+
 
 class WSServer(object):
-    def __init__(self, bot):
+    def __init__(self, bot, sound_files):
         self.bot = bot
-        nest_asyncio.apply()
+        self.sound_files = sound_files
+        self.subscribers = {}
+        self._server = None
+        self.handlers = {
+            'play': self._play,
+            'random': self._random,
+            'stop': self._stop,
+            'list': self._list,
+            'subscribe': self._subscribe,
+            'unsubscribe': self._unsubscribe
+        }
+
+        self.bot.add_listener(self._on_now_playing, 'on_now_playing')
+        self.bot.add_listener(self._on_voice_queue, 'on_voice_queue')
+        self.sound_files.add_listener(self._on_files_changed)
 
 
-    def start(self, event_loop):
-        start_server = websockets.serve(self.serve, "0.0.0.0", WS_PORT)
-        event_loop.run_until_complete(start_server)
+    async def start(self):
+        if self._server:
+            return
+
+        self._server = await websockets.serve(self.serve, "0.0.0.0", WS_PORT)
         print(f'Websocket server running on port {WS_PORT}')
 
 
-    async def serve(self, websocket, path):
-        while True:
-            req = await websocket.recv()
+    async def stop(self):
+        if not self._server:
+            return
+
+        for websocket in list(self.subscribers):
+            self._remove_subscriber(websocket)
+
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        print('Websocket server stopped')
+
+
+    async def serve(self, websocket, path=None):
+        sem = asyncio.Semaphore(WS_MAX_CONCURRENT)
+        tasks = set()
+
+        try:
+            async for req in websocket:
+                # Stop reading from the socket while the connection is at its limit
+                await sem.acquire()
+                task = asyncio.ensure_future(self._handle(websocket, req, sem))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            self._remove_subscriber(websocket)
+
+
+    async def _handle(self, websocket, req, sem):
+        req_id = None
+        action = None
+
+        try:
             print(f"Websocket request {req}")
+            req_json = self._parse(req)
+            req_id = req_json.get('id')
+            action = req_json.get('action')
+            self._validate(req_json)
+            msg = await self.handlers[action](websocket, req_json)
+            await self.return_msg(websocket, req_id, 'playing' if action in ('play', 'random') else action, msg)
+        except WSError as e:
+            await self.return_err(websocket, req_id, action, e.code, e.message)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f'Websocket request failed - {e}')
+            await self.return_err(websocket, req_id, action, 'internal_error', 'The request could not be completed')
+        finally:
+            sem.release()
+
+
+    def _parse(self, req):
+        try:
             req_json = json.loads(req)
+        except ValueError:
+            raise WSError('invalid_json', 'The request is not valid JSON')
+
+        if not isinstance(req_json, dict):
+            raise WSError('invalid_request', 'The request must be a JSON object')
+
+        return req_json
+
+
+    def _validate(self, req_json):
+        if 'action' not in req_json:
+            raise WSError('invalid_request', "The 'action' property is required")
+
+        action = req_json['action']
+
+        if action not in self.handlers:
+            raise WSError('unknown_action', f"Unknown action '{action}'")
+
+        for field, field_type in REQUEST_SCHEMAS[action].items():
+            if field not in req_json:
+                raise WSError('invalid_request', f"The '{field}' property is required for '{action}'")
+
+            if not isinstance(req_json[field], field_type):
+                raise WSError('invalid_request', f"The '{field}' property has the wrong type")
+
+
+    def _get_channel(self, user_id):
+        try:
+            return get_channel_from_user_id(self.bot, user_id)
+        except ValueError:
+            raise WSError('invalid_request', f"'{user_id}' is not a valid user ID")
+        except Exception:
+            raise WSError('not_in_voice', f'User {user_id} is not in a voice channel')
+
+
+    async def _play(self, websocket, req_json):
+        channel = self._get_channel(req_json['user_id'])
+        sound_file = self.sound_files.find(req_json['filename'])
+
+        if not sound_file:
+            raise WSError('not_found', f"Could not find sound '{req_json['filename']}'")
+
+        await self.bot.voice.play(channel=channel, source=sound_file.get_path(), title=sound_file.name)
+        return sound_file.name
+
+
+    async def _random(self, websocket, req_json):
+        channel = self._get_channel(req_json['user_id'])
+        sound_file = self.sound_files.random()
+        await self.bot.voice.play(channel=channel, source=sound_file.get_path(), title=sound_file.name)
+        return sound_file.name
+
+
+    async def _stop(self, websocket, req_json):
+        channel = self._get_channel(req_json['user_id'])
+        await self.bot.voice.stop(channel.guild.id)
+        return None
+
+
+    async def _list(self, websocket, req_json):
+        return [f.name for f in self.sound_files.list_files()]
+
+
+    async def _subscribe(self, websocket, req_json):
+        if websocket not in self.subscribers:
+            subscriber = WSSubscriber(websocket)
+            self.subscribers[websocket] = subscriber
+
+            for guild_id, session in self.bot.voice.sessions.items():
+                subscriber.push(f'now_playing:{guild_id}', self._event('now_playing', self._now_playing_msg(guild_id, session.now_playing)))
+
+        return True
+
+
+    async def _unsubscribe(self, websocket, req_json):
+        self._remove_subscriber(websocket)
+        return False
+
+
+    def _remove_subscriber(self, websocket):
+        subscriber = self.subscribers.pop(websocket, None)
+
+        if subscriber:
+            subscriber.close()
+
+
+    def broadcast(self, key, action, msg):
+        event = self._event(action, msg)
+
+        for subscriber in list(self.subscribers.values()):
+            subscriber.push(key, event)
+
+
+    def _event(self, action, msg):
+        return json.dumps({
+            'id': None,
+            'action': action,
+            'msg': msg
+        })
+
+
+    def _now_playing_msg(self, guild_id, now_playing):
+        return {
+            'guild_id': guild_id,
+            'title': now_playing['title'] if now_playing else None
+        }
+
 
-            if 'action' not in req_json:
-                await self.return_err(websocket, None, "The 'action' property is required")
-                return
+    async def _on_now_playing(self, guild_id, now_playing):
+        self.broadcast(f'now_playing:{guild_id}', 'now_playing', self._now_playing_msg(guild_id, now_playing))
 
-            action = req_json['action']
 
-            if action == 'play' or  action == 'random':
-                channel = self.bot.voice_control.get_channel_from_user_id(req_json['user_id'])
+    async def _on_voice_queue(self, guild_id, titles):
+        self.broadcast(f'queue:{guild_id}', 'queue', {
+            'guild_id': guild_id,
+            'queue': titles
+        })
 
-                now_playing = await self.bot.voice_control.play(channel, req_json['filename']) \
-                    if action == 'play' else \
-                        await self.bot.voice_control.play_random(channel)
 
-                await self.return_msg(websocket, 'playing', now_playing)
-            elif action == 'stop':
-                self.bot.voice_control.stop()
-            elif action == 'list':
-                await self.return_msg(websocket, action, self.bot.file_manager.list_filenames())
+    def _on_files_changed(self, event, file_obj):
+        # File repo events arrive on the Pub/Sub thread
+        self.bot.loop.call_soon_threadsafe(self.broadcast, 'files_changed', 'files_changed', event)
 
 
-    async def return_msg(self, websocket, action, msg):
+    async def return_msg(self, websocket, req_id, action, msg):
         msg = {
+            'id': req_id,
             'action': action,
             'msg': msg
         }
@@ -51,10 +291,14 @@ class WSServer(object):
         await websocket.send(json.dumps(msg))
 
 
-    async def return_err(self, websocket, action, msg):
+    async def return_err(self, websocket, req_id, action, code, msg):
         err = {
+            'id': req_id,
             'action': action,
-            'err': str(msg)
+            'err': {
+                'code': code,
+                'message': str(msg)
+            }
         }
         print(err)
         await websocket.send(json.dumps(err))
@@ -7,7 +7,8 @@ import discord
 from discord.ext import commands
 from discord.utils import get
 
-from utils.discord_helpers import send_text_list_to_author
+from bot.voice import PRIORITY_ENTRANCE
+from utils.discord_helpers import TextListCache, send_text_page_to_author
 
 
 class Entrances(commands.Cog):
@@ -15,6 +16,10 @@ class Entrances(commands.Cog):
         self.bot = bot
         self.user_manager = user_manager
         self.sound_files = sound_files
+        self.list_cache = TextListCache(
+            get_version=lambda: self.user_manager.version,
+            get_strings=lambda: [f'{u.user_name}: {u.entrance_filename}' for u in self.user_manager.users]
+        )
 
 
     @commands.command(name='entrance', help='Set a users entrance audio')
@@ -26,22 +31,29 @@ class Entrances(commands.Cog):
             await ctx.send(f'Could not find audio file \'{filename}\'')
             return
 
-        self.user_manager.add_entrance(user.id, filename)
+        if not await self.user_manager.add_entrance(user.id, filename):
+            await ctx.send(f'Could not set user {user} entrance audio, saving it failed')
+            return
 
         msg = f'User {user} entrance audio has been set to \'{filename}\''
         print(msg)
         await ctx.send(msg)
 
 
-    @commands.command(name='list_entrances', help='List all entrance sounds')
-    async def list_entrances(self, ctx):
+    @commands.command(name='list_entrances', help='List all entrance sounds, optionally filtered by user name prefix and paged')
+    async def list_entrances(self, ctx, prefix=None, page: int=1):
         print(f'List entrance sounds request from {ctx.message.author}')
 
-        entrances = []
-        for u in self.user_manager.users:
-            entrances.append(f'{u.user_name}: {u.entrance_filename}')
+        if prefix and prefix.isdigit():
+            prefix, page = None, int(prefix)
+
+        pages = self.list_cache.get_pages(prefix)
+
+        if not pages:
+            await ctx.message.author.send('There are no matching entrances')
+            return
 
-        await send_text_list_to_author(ctx, entrances)
+        await send_text_page_to_author(ctx, pages, page=page, prefix=prefix)
 
 
     @commands.Cog.listener()
@@ -50,13 +62,14 @@ class Entrances(commands.Cog):
             return
 
         if after.channel and before.channel != after.channel:
-            user = self.user_manager.get_user(member.id)
+            user = await self.user_manager.get_user(member.id)
 
             if user and user.entrance_filename:
                 print(f'{member.name} has arrived in {after.channel.name} playing entrance audio \'{user.entrance_filename}\'')
+                self.bot.voice.prejoin(after.channel)
                 try:
                     sound_file = self.sound_files.find(user.entrance_filename)
-                    await self.bot.voice.play(channel=after.channel, source=sound_file.get_path(), title=sound_file.name, delay=1)
+                    await self.bot.voice.play(channel=after.channel, source=sound_file.get_path(), title=sound_file.name, priority=PRIORITY_ENTRANCE)
                 except Exception as e:
                     print(e)
                     print(f'Failed to play {member.name} entrance audio \'{user.entrance_filename}\'')
\ No newline at end of file
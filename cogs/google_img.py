@@ -1,21 +1,48 @@
 import os
 import discord
-import sys
+import asyncio
+import httpx
+
+from concurrent.futures import ThreadPoolExecutor
 
 from google_images_search import GoogleImagesSearch
 from io import BytesIO
-from PIL import Image
 
 from discord.ext import commands
 
+from utils.image_cache import ImageSearchCache
+from utils.discord_helpers import sniff_image_type, create_img_bytes, MAX_IMG_BYTES
+
 MAX_IMG_COUNT = 5
-MAX_IMG_SIZE_MB = 8
+MAX_DOWNLOAD_SIZE_MB = 32
+MAX_DOWNLOAD_BYTES = MAX_DOWNLOAD_SIZE_MB * 1024**2
+SEARCH_RESULT_COUNT = MAX_IMG_COUNT * 2
+IMG_CHUNK_SIZE = 64 * 1024
+IMG_SNIFF_BYTES = 12
+IMG_WORKERS = 2
+IMG_FETCH_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+IMG_FETCH_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+IMG_FETCH_HEADERS = {'User-Agent': 'Mozilla/5.0 (compatible; jeff_bot)'}
+
 
 class GoogleImages(commands.Cog):
-    def __init__(self, bot, api_token, api_cx):
+    def __init__(self, bot, api_token, api_cx, cache=None):
         self.bot = bot
         self.api_token = api_token
         self.api_cx = api_cx
+        self.cache = cache or ImageSearchCache()
+        self._client = httpx.AsyncClient(
+            headers=IMG_FETCH_HEADERS,
+            timeout=IMG_FETCH_TIMEOUT,
+            limits=IMG_FETCH_LIMITS,
+            follow_redirects=True
+        )
+        self._img_pool = ThreadPoolExecutor(max_workers=IMG_WORKERS, thread_name_prefix='img')
+
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self._client.aclose())
+        self._img_pool.shutdown(wait=False)
 
 
     @commands.command(name='img', help='Search for an image')
@@ -26,53 +53,131 @@ class GoogleImages(commands.Cog):
 
     # Turns out a lot of images where being downloaded that wern't images,
     # they were just captcha pages or the site stopping the image scrape.
-    # In order to prevent this we query for twice the images that you want
-    # and try and replace broken images with the spare ones. The test for a
-    # broken image is to try and decode it into a UTF-8 string, if it fails
-    # the decoding it is an image and not a website. This can't be checked
-    # the other way around because the website bytes can be written to an image.
+    # In order to prevent this we query for twice the images that you want,
+    # download them all at once and send the first ones that pass. A payload
+    # only passes if it starts with the magic bytes of a known image format,
+    # so error pages are thrown away after the first chunk arrives. Images
+    # too big for a Discord upload are shrunk in the worker pool rather than
+    # being thrown away.
 
     async def _search(self, ctx, query, size, file_type, count):
-        gis = GoogleImagesSearch(self.api_token, self.api_cx)
-
         if count > MAX_IMG_COUNT:
             count = MAX_IMG_COUNT
 
+        urls = self.cache.get_urls(query)
+
+        if urls is None:
+            try:
+                urls = await self.bot.loop.run_in_executor(None, self._search_urls, query)
+            except Exception as e:
+                print(f'Image search for {query} failed - {e}')
+                await ctx.send(f'Image search for `{query}` failed')
+                return
+
+            self.cache.add_urls(query, urls)
+
+        tasks = [asyncio.ensure_future(self._get_image(url)) for url in urls]
+        return_count = 0
+
+        try:
+            for next_img in asyncio.as_completed(tasks):
+                img = await next_img
+
+                if not img:
+                    continue
+
+                img_bytes, ext = img
+                await ctx.send(file=discord.File(BytesIO(img_bytes), f'{query}_{return_count}.{ext}'))
+
+                return_count += 1
+                if return_count >= count:
+                    break
+        finally:
+            # Anything still downloading is a spare we no longer need
+            for task in tasks:
+                task.cancel()
+
+        print(f'Sent {return_count}/{count} images for {query} from {len(urls)} results')
+        print(f'Image cache stats {self.cache.stats()}')
+
+
+    @commands.command(name='img_stats', help='Show the image search cache stats')
+    async def img_stats(self, ctx):
+        stats = self.cache.stats()
+        await ctx.send(
+            f'Searches: {stats["query_hits"]} cached / {stats["query_misses"]} API calls '
+            f'({stats["query_hit_rate"]:.0%} hit rate, {stats["api_calls_saved"]} API calls saved)\n'
+            f'Images: {stats["image_hits"] + stats["disk_hits"]} cached / {stats["image_misses"]} downloaded '
+            f'({stats["image_hit_rate"]:.0%} hit rate, {stats["bytes_saved"] / 1024**2:.1f}MB not downloaded)'
+        )
+
+
+    def _search_urls(self, query):
+        gis = GoogleImagesSearch(self.api_token, self.api_cx)
         gis.search({
             'q': query,
-            'num': MAX_IMG_COUNT
+            'num': SEARCH_RESULT_COUNT
         })
 
-        bytes_io = BytesIO()
-        return_count = 0
+        return [img.url for img in gis.results()]
 
 
-        for i, img in enumerate(gis.results()):
-            try:
-                bytes_io.seek(0)
-                raw_image_data = img.get_raw_data()
-            except Exception as e:
-                print('There was an issue getting the image')
-                print(e)
-                continue
+    async def _get_image(self, url):
+        cached = await self.bot.loop.run_in_executor(None, self.cache.get_image, url)
 
-            try:
-                print('Testing image...')
-                _ = raw_image_data.decode('utf-8')
-                print('Image test failed, ignoring image')
-            except:
-                img.copy_to(bytes_io, raw_image_data)
-                img.copy_to(bytes_io)
-                bytes_io.seek(0)
-
-                img_size = sys.getsizeof(bytes_io)
-
-                if img_size < MAX_IMG_SIZE_MB * (4**10):
-                    print('Image is valid')
-                    await ctx.send(file=discord.File(bytes_io, f'{query}_{i}.{file_type}'))
-
-                    return_count += 1
-                    if return_count >= count:
-                        break
-                else:
-                    print(f'Image ({img_size}) is larger than {MAX_IMG_SIZE_MB * (4**10)}')
\ No newline at end of file
+        if cached:
+            return cached
+
+        img = await self._fetch_image(url)
+
+        if img and len(img[0]) > MAX_IMG_BYTES:
+            img = await self.bot.loop.run_in_executor(self._img_pool, create_img_bytes, img[0])
+
+        if img:
+            await self.bot.loop.run_in_executor(None, self.cache.add_image, url, *img)
+        else:
+            self.cache.mark_bad(url)
+
+        return img
+
+
+    async def _fetch_image(self, url):
+        try:
+            async with self._client.stream('GET', url) as response:
+                if response.status_code != 200:
+                    print(f'Image request failed ({response.status_code}) {url}')
+                    return None
+
+                content_length = response.headers.get('content-length')
+
+                if content_length and content_length.isdigit() and int(content_length) > MAX_DOWNLOAD_BYTES:
+                    print(f'Image ({content_length}) is larger than {MAX_DOWNLOAD_BYTES} {url}')
+                    return None
+
+                img_bytes = bytearray()
+                ext = None
+
+                async for chunk in response.aiter_bytes(IMG_CHUNK_SIZE):
+                    img_bytes += chunk
+
+                    if ext is None and len(img_bytes) >= IMG_SNIFF_BYTES:
+                        ext = sniff_image_type(img_bytes)
+
+                        if not ext:
+                            print(f'Image test failed, this is not an image {url}')
+                            return None
+
+                    if len(img_bytes) > MAX_DOWNLOAD_BYTES:
+                        print(f'Image is larger than {MAX_DOWNLOAD_BYTES} {url}')
+                        return None
+
+                ext = ext or sniff_image_type(img_bytes)
+
+                if not ext:
+                    print(f'Image test failed, this is not an image {url}')
+                    return None
+
+                return bytes(img_bytes), ext
+        except httpx.HTTPError as e:
+            print(f'There was an issue getting the image {url} - {e}')
+            return None
@@ -0,0 +1,228 @@
+import os
+import math
+import json
+import time
+import random
+
+from cogs.maps.location import Location
+
+COVERAGE_CACHE_PATH = '.street_view_coverage.json'
+COVERAGE_CELL_PRECISION = 6
+COVERAGE_BUCKET_PRECISION = 3
+COVERAGE_HIT_TTL = 30 * 24 * 60 * 60
+COVERAGE_MISS_TTL = 7 * 24 * 60 * 60
+DEAD_CELL_MISSES = 3
+MAX_DEAD_CELLS = 100000
+MAX_BUCKET_PANOS = 500
+MIN_SAMPLE_DISTANCE = 0.1
+COVERAGE_SAVE_INTERVAL = 60
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+R_EARTH = 6378
+
+
+def geohash_encode(lat, lng, precision):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        value_range, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (value_range[0] + value_range[1]) / 2
+
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def _offset(lat, lng, x_km, y_km):
+    new_lat = lat + (x_km / R_EARTH) * (180 / math.pi)
+    new_lng = lng + (y_km / R_EARTH) * (180 / math.pi) / math.cos(lat * math.pi / 180)
+    return new_lat, new_lng
+
+
+def _approx_distance(lat1, lng1, lat2, lng2):
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return R_EARTH * math.sqrt(x * x + y * y)
+
+
+class CoverageCache:
+    def __init__(self, path=COVERAGE_CACHE_PATH, hit_ttl=COVERAGE_HIT_TTL, miss_ttl=COVERAGE_MISS_TTL):
+        self.path = path
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.lookups = 0
+        self.dead_skips = 0
+        self.samples = 0
+        self.sample_hits = 0
+        self.probe_hits = 0
+        self.probe_misses = 0
+        self._dead = {}
+        self._panos = {}
+        self._dirty = False
+        self._saved_on = time.monotonic()
+
+        self._load()
+
+
+    def _cell(self, lat, lng):
+        return geohash_encode(lat, lng, COVERAGE_CELL_PRECISION)
+
+
+    def is_dead(self, loc):
+        self.lookups += 1
+        entry = self._dead.get(self._cell(loc.lat, loc.lng))
+
+        if entry and entry[0] >= DEAD_CELL_MISSES and entry[1] > time.time():
+            self.dead_skips += 1
+            return True
+
+        return False
+
+
+    def record_miss(self, loc):
+        self.probe_misses += 1
+        cell = self._cell(loc.lat, loc.lng)
+        entry = self._dead.get(cell)
+        now = time.time()
+
+        # The miss TTL runs from the first miss so stale dead cells get retried
+        if not entry or entry[1] <= now:
+            entry = [0, now + self.miss_ttl]
+            self._dead[cell] = entry
+
+        entry[0] += 1
+        self._dirty = True
+
+
+    def record_hit(self, probe_loc, pano_loc):
+        self.probe_hits += 1
+        self._dead.pop(self._cell(probe_loc.lat, probe_loc.lng), None)
+
+        bucket = self._panos.setdefault(geohash_encode(pano_loc.lat, pano_loc.lng, COVERAGE_BUCKET_PRECISION), {})
+        bucket[f'{pano_loc.lat:.6f},{pano_loc.lng:.6f}'] = [pano_loc.lat, pano_loc.lng, time.time() + self.hit_ttl]
+
+        if len(bucket) > MAX_BUCKET_PANOS:
+            del bucket[min(bucket, key=lambda k: bucket[k][2])]
+
+        self._dirty = True
+
+
+    def sample_near(self, loc, radius):
+        self.samples += 1
+        now = time.time()
+
+        # Buckets are far larger than a clue radius, so the buckets under the
+        # centre and eight points on the circle cover the whole search area
+        buckets = set()
+
+        for i in range(9):
+            x, y = (0, 0) if i == 0 else (radius * math.cos(i * math.pi / 4), radius * math.sin(i * math.pi / 4))
+            lat, lng = _offset(loc.lat, loc.lng, x, y)
+            buckets.add(geohash_encode(lat, lng, COVERAGE_BUCKET_PRECISION))
+
+        candidates = []
+
+        for bucket in buckets:
+            for lat, lng, expires in self._panos.get(bucket, {}).values():
+                if expires <= now:
+                    continue
+
+                # Never hand back the starting point itself, clues have to move
+                if MIN_SAMPLE_DISTANCE <= _approx_distance(loc.lat, loc.lng, lat, lng) <= radius:
+                    candidates.append((lat, lng))
+
+        if not candidates:
+            return None
+
+        self.sample_hits += 1
+        lat, lng = random.choice(candidates)
+        return Location(lat, lng)
+
+
+    def _prune(self):
+        now = time.time()
+        self._dead = {c: e for c, e in self._dead.items() if e[1] > now}
+
+        if len(self._dead) > MAX_DEAD_CELLS:
+            keep = sorted(self._dead.items(), key=lambda i: i[1][1])[-MAX_DEAD_CELLS:]
+            self._dead = dict(keep)
+
+        for bucket_key in list(self._panos):
+            bucket = {k: p for k, p in self._panos[bucket_key].items() if p[2] > now}
+
+            if bucket:
+                self._panos[bucket_key] = bucket
+            else:
+                del self._panos[bucket_key]
+
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                cache_json = json.load(f)
+
+            self._dead = cache_json['dead']
+            self._panos = cache_json['panos']
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Ignoring corrupt street view coverage cache {self.path} - {e}')
+            self._dead = {}
+            self._panos = {}
+
+        self._prune()
+        print(f'Loaded street view coverage for {len(self._dead)} cells with misses and {sum(len(b) for b in self._panos.values())} panoramas')
+
+
+    # Serialises on the caller's thread and returns a function that does the
+    # write, so the file write can go to an executor. None if nothing to save
+    def snapshot(self, force=False):
+        if not self._dirty or (not force and time.monotonic() - self._saved_on < COVERAGE_SAVE_INTERVAL):
+            return None
+
+        self._prune()
+        data = json.dumps({'dead': self._dead, 'panos': self._panos})
+        self._dirty = False
+        self._saved_on = time.monotonic()
+
+        return lambda: self._write(data)
+
+
+    def _write(self, data):
+        tmp_path = f'{self.path}.part'
+
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+
+        os.replace(tmp_path, self.path)
+
+
+    def stats(self):
+        return {
+            'dead_cells': sum(1 for e in self._dead.values() if e[0] >= DEAD_CELL_MISSES),
+            'panoramas': sum(len(b) for b in self._panos.values()),
+            'probe_hits': self.probe_hits,
+            'probe_misses': self.probe_misses,
+            'dead_skips': self.dead_skips,
+            'dead_skip_rate': self.dead_skips / self.lookups if self.lookups else 0,
+            'sample_hits': self.sample_hits,
+            'sample_hit_rate': self.sample_hits / self.samples if self.samples else 0
+        }
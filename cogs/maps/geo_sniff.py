@@ -4,6 +4,7 @@ import asyncio
 import httpx
 import json
 
+from io import BytesIO
 from os.path import dirname
 from datetime import datetime
 from utils.game import GuessGame
@@ -11,8 +12,11 @@ from discord.ext import commands
 from urllib.parse import urljoin
 from cogs.maps.geo_sniff_game import GeoSniffGame
 from cogs.maps.location import Location
-from cogs.maps.street_view import StreetView
+from cogs.maps.street_view import StreetView, GRID_FORMAT, GRID_QUALITY
+from cogs.maps.round_pool import RoundPool, ROUND_POOL_SIZE
+from cogs.maps.coverage_cache import CoverageCache
 from texttable import Texttable
+from utils.discord_helpers import sniff_image_type
 
 GAME_TIME = 90
 CLUE_TIME = 30
@@ -24,12 +28,36 @@ GAME_NAME = 'geosniff'
 HEADERS = {'Content-type':'application/json', 'Accept':'application/json'}
 
 class GeoSniff(commands.Cog):
-    def __init__(self, bot, geo_sniff_api_url, geo_score_api_url, google_api_token):
+    def __init__(self, bot, geo_sniff_api_url, geo_score_api_url, google_api_token, round_pool_size=ROUND_POOL_SIZE,
+                 grid_format=GRID_FORMAT, grid_quality=GRID_QUALITY):
         self.bot = bot
         self.geo_sniff_api_url = geo_sniff_api_url
         self.geo_score_api_url = geo_score_api_url
         self.current_games = []
-        self.street_view = StreetView(geo_sniff_api_url, google_api_token)
+        self.street_view = StreetView(
+            geo_sniff_api_url,
+            google_api_token,
+            grid_format=grid_format,
+            grid_quality=grid_quality,
+            coverage=CoverageCache()
+        )
+        self.round_pool = RoundPool(self.street_view, size=round_pool_size)
+
+
+    def cog_unload(self):
+        self.round_pool.stop()
+        self.bot.loop.create_task(self.street_view.close())
+
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.round_pool.start()
+
+
+    def _grid_file(self, img_grid_bytes):
+        # Pooled rounds may have been rendered before the grid format changed
+        ext = sniff_image_type(img_grid_bytes.getvalue()) or 'png'
+        return discord.File(img_grid_bytes, f'where-is-jeff.{ext}')
 
 
     def _get_game_in_progress(self, guild_id):
@@ -50,7 +78,14 @@ class GeoSniff(commands.Cog):
         self.current_games.append(game)
         await ctx.send(f'Jeff is sniffing one out...')
 
-        loc = await self.street_view.get_random_location()
+        prepared = self.round_pool.get()
+
+        if prepared:
+            loc = prepared.location
+            img_grid_bytes = BytesIO(prepared.img_bytes)
+        else:
+            loc = await self.street_view.get_random_location()
+            img_grid_bytes = None
 
         game.set_answer(location=loc)
 
@@ -62,13 +97,14 @@ class GeoSniff(commands.Cog):
             }))
             game.set_id(resp.json())
 
-        img_grid_bytes = await self.street_view.create_img_grid(loc)
+        if not img_grid_bytes:
+            img_grid_bytes = await self.street_view.create_img_grid(loc)
 
         print(f'Geo Sniff Jeff has arrived at {game.get_answer()}')
 
         await ctx.channel.send(
             content='**Where is Jeff?**',
-            file=discord.File(img_grid_bytes, 'where-is-jeff.png')
+            file=self._grid_file(img_grid_bytes)
         )
 
         game.start()
@@ -119,7 +155,7 @@ class GeoSniff(commands.Cog):
 
         await ctx.channel.send(
             content=f'**Jeff has moved {clue_delta:.2f} km**',
-            file=discord.File(img_grid_bytes, 'where-is-jeff.png')
+            file=self._grid_file(img_grid_bytes)
         )
 
 
@@ -179,6 +215,19 @@ class GeoSniff(commands.Cog):
             return
 
 
+    @commands.command(name='sniff_pool', help='Show how many Geo Sniff rounds are ready')
+    async def sniff_pool(self, ctx):
+        stats = self.round_pool.stats()
+        coverage = self.street_view.coverage.stats()
+        await ctx.channel.send(
+            f'{stats["depth"]}/{stats["size"]} rounds ready, {stats["served"]} served from the pool, {stats["misses"]} built on demand\n'
+            f'Refill time: last {stats["last_refill_s"]:.1f}s, average {stats["avg_refill_s"]:.1f}s\n'
+            f'Coverage cache: {coverage["panoramas"]} panoramas, {coverage["dead_cells"]} dead cells, '
+            f'{coverage["dead_skips"]} probes skipped ({coverage["dead_skip_rate"]:.0%}), '
+            f'{coverage["sample_hits"]} known panoramas reused ({coverage["sample_hit_rate"]:.0%})'
+        )
+
+
     @commands.command(name='sniffers', help='Get the Geo Sniff leaderboard')
     async def leaderboard(self, ctx):
         async with httpx.AsyncClient() as client:
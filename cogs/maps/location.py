@@ -14,6 +14,28 @@ class Location(object):
         self.sub_area = sub_area
 
 
+    def to_dict(self):
+        return {
+            'lat': self.lat,
+            'lng': self.lng,
+            'heading': self.heading,
+            'country': getattr(self, 'country', None),
+            'area': getattr(self, 'area', None),
+            'sub_area': getattr(self, 'sub_area', None)
+        }
+
+
+    @staticmethod
+    def from_dict(loc_dict):
+        loc = Location(loc_dict['lat'], loc_dict['lng'], loc_dict.get('heading', 0))
+        loc.add_name_data(
+            country=loc_dict.get('country'),
+            area=loc_dict.get('area'),
+            sub_area=loc_dict.get('sub_area')
+        )
+        return loc
+
+
     def street_view_img_url(self, api_key):
         return STREET_VIEW_API_URL.format(self.lat, self.lng, self.heading, api_key)
 
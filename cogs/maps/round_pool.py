@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+
+from collections import deque
+
+from cogs.maps.location import Location
+
+ROUND_POOL_SIZE = 3
+ROUND_POOL_DIR = '.geo_rounds'
+ROUND_RETRY_DELAY = 30
+
+
+class PreparedRound(object):
+    def __init__(self, round_id, location, img_bytes):
+        self.round_id = round_id
+        self.location = location
+        self.img_bytes = img_bytes
+
+
+class RoundPool:
+    def __init__(self, street_view, size=ROUND_POOL_SIZE, pool_dir=ROUND_POOL_DIR):
+        self.street_view = street_view
+        self.size = size
+        self.pool_dir = pool_dir
+        self.served = 0
+        self.misses = 0
+        self.refill_times = deque(maxlen=50)
+        self._rounds = deque()
+        self._need = asyncio.Event()
+        self._task = None
+
+        os.makedirs(self.pool_dir, exist_ok=True)
+        self._load_rounds()
+
+
+    # Safe to call on every on_ready, only one producer ever runs
+    def start(self):
+        if self._task and not self._task.done():
+            return
+
+        self._need.set()
+        self._task = asyncio.ensure_future(self._produce())
+        print(f'Geo Sniff round pool started with {len(self._rounds)}/{self.size} rounds ready')
+
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+    def get(self):
+        self._need.set()
+
+        if not self._rounds:
+            self.misses += 1
+            print(f'Geo Sniff round pool is empty {self.stats()}')
+            return None
+
+        prepared = self._rounds.popleft()
+        self._remove_round(prepared.round_id)
+        self.served += 1
+        print(f'Geo Sniff round taken from pool {self.stats()}')
+        return prepared
+
+
+    async def _produce(self):
+        while True:
+            await self._need.wait()
+            self._need.clear()
+
+            while len(self._rounds) < self.size:
+                start = time.perf_counter()
+
+                try:
+                    prepared = await self._prepare_round()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f'Unable to prepare Geo Sniff round - {e}')
+                    await asyncio.sleep(ROUND_RETRY_DELAY)
+                    continue
+
+                self.refill_times.append(time.perf_counter() - start)
+                self._rounds.append(prepared)
+                print(f'Geo Sniff round prepared in {self.refill_times[-1]:.1f}s {self.stats()}')
+
+
+    async def _prepare_round(self):
+        loc = await self.street_view.get_random_location()
+        img_grid_bytes = await self.street_view.create_img_grid(loc)
+        prepared = PreparedRound(uuid.uuid4().hex, loc, img_grid_bytes.getvalue())
+        await asyncio.get_event_loop().run_in_executor(None, self._save_round, prepared)
+        return prepared
+
+
+    def _round_paths(self, round_id):
+        base = os.path.join(self.pool_dir, round_id)
+        return f'{base}.json', f'{base}.img'
+
+
+    def _save_round(self, prepared):
+        json_path, img_path = self._round_paths(prepared.round_id)
+
+        with open(img_path, 'wb') as f:
+            f.write(prepared.img_bytes)
+
+        # The json is written last so a round is only loaded once both exist
+        with open(f'{json_path}.part', 'w') as f:
+            json.dump({
+                'created': time.time(),
+                'location': prepared.location.to_dict()
+            }, f)
+
+        os.replace(f'{json_path}.part', json_path)
+
+
+    def _remove_round(self, round_id):
+        for path in self._round_paths(round_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def _load_rounds(self):
+        entries = []
+
+        for entry in os.scandir(self.pool_dir):
+            if not entry.name.endswith('.json'):
+                # Images and partial writes left behind by a crash mid save
+                if not os.path.exists(os.path.join(self.pool_dir, f'{os.path.splitext(entry.name)[0]}.json')):
+                    os.remove(entry.path)
+
+                continue
+
+            round_id = entry.name[:-len('.json')]
+            json_path, img_path = self._round_paths(round_id)
+
+            try:
+                with open(json_path) as f:
+                    round_json = json.load(f)
+
+                with open(img_path, 'rb') as f:
+                    img_bytes = f.read()
+            except (OSError, ValueError) as e:
+                print(f'Ignoring broken Geo Sniff round {round_id} - {e}')
+                self._remove_round(round_id)
+                continue
+
+            entries.append((round_json['created'], PreparedRound(round_id, Location.from_dict(round_json['location']), img_bytes)))
+
+        for _, prepared in sorted(entries, key=lambda e: e[0]):
+            self._rounds.append(prepared)
+
+
+    def stats(self):
+        avg_refill = sum(self.refill_times) / len(self.refill_times) if self.refill_times else 0
+
+        return {
+            'depth': len(self._rounds),
+            'size': self.size,
+            'served': self.served,
+            'misses': self.misses,
+            'last_refill_s': self.refill_times[-1] if self.refill_times else 0,
+            'avg_refill_s': avg_refill
+        }
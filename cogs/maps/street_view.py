@@ -1,5 +1,6 @@
 import math
 import httpx
+import asyncio
 import numpy as np
 
 from io import BytesIO
@@ -13,76 +14,199 @@ IMG_HEIGHT = 640
 RADIUS_ATTEMPTS = 150
 RADIUS_GROW_CNT = 5
 RADIUS_MULTI = 1.5
+PROBE_WAVE_SIZE = 10
+KNOWN_GOOD_CHANCE = 0.5
+MAPS_API_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+MAPS_API_LIMITS = httpx.Limits(max_connections=PROBE_WAVE_SIZE * 2, max_keepalive_connections=PROBE_WAVE_SIZE)
+GRID_FORMATS = ('png', 'jpeg', 'webp')
+GRID_FORMAT = 'png'
+GRID_QUALITY = 85
 REV_GEO_API_URL = 'https://maps.googleapis.com/maps/api/geocode/json?latlng={},{}&key={}'
 
 
+def compose_img_grid(tiles, img_format=GRID_FORMAT, quality=GRID_QUALITY):
+    w = (IMG_BORDER * 3) + (IMG_WIDTH * 2)
+    h = (IMG_BORDER * 3) + (IMG_HEIGHT * 2)
+    img = Image.new('RGB', (w, h), (255, 255, 255))
+
+    for i, tile_bytes in enumerate(tiles):
+        map_img = Image.open(tile_bytes)
+        x = IMG_BORDER + (i % 2) * (IMG_WIDTH + IMG_BORDER)
+        y = IMG_BORDER + (i // 2) * (IMG_HEIGHT + IMG_BORDER)
+        img.paste(map_img, (x, y))
+
+    full_img_bytes = BytesIO()
+
+    if img_format == 'png':
+        img.save(full_img_bytes, format='png')
+    else:
+        img.save(full_img_bytes, format=img_format, quality=quality)
+
+    full_img_bytes.seek(0)
+    return full_img_bytes
+
+
 class StreetView:
-    def __init__(self, geo_sniff_api_url, google_api_token):
+    def __init__(self, geo_sniff_api_url, google_api_token, probe_wave_size=PROBE_WAVE_SIZE, grid_format=GRID_FORMAT, grid_quality=GRID_QUALITY,
+                 coverage=None):
+        if grid_format not in GRID_FORMATS:
+            raise Exception(f'Unsupported grid format {grid_format}, use one of {GRID_FORMATS}')
+
         self.api_token = google_api_token
         self.geo_sniff_api_url = geo_sniff_api_url
+        self.probe_wave_size = probe_wave_size
+        self.grid_format = grid_format
+        self.grid_quality = grid_quality
+        self.coverage = coverage
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=MAPS_API_TIMEOUT,
+            limits=MAPS_API_LIMITS
+        )
+
+
+    async def close(self):
+        await self._save_coverage(force=True)
+        await self._client.aclose()
+
+
+    async def _save_coverage(self, force=False):
+        if not self.coverage:
+            return
+
+        write = self.coverage.snapshot(force=force)
+
+        if write:
+            await asyncio.get_event_loop().run_in_executor(None, write)
 
 
     async def get_random_location(self):
         final_loc = None
 
-        async with httpx.AsyncClient() as client:
-            while not final_loc:
-                resp = await client.get(self.geo_sniff_api_url)
-                resp_json = resp.json()
+        while not final_loc:
+            resp = await self._client.get(self.geo_sniff_api_url)
+            resp_json = resp.json()
+
+            city_loc = Location(resp_json['lat'], resp_json['long'])
+            loc_rad = resp_json['radius']
 
-                city_loc = Location(resp_json['lat'], resp_json['long'])
-                loc_rad = resp_json['radius']
+            final_loc = await self.find_random_street_view_loc(starting_loc=city_loc, radius=loc_rad)
 
-                final_loc = await self.find_random_street_view_loc(starting_loc=city_loc, radius=loc_rad)
+            if final_loc:
+                return await self.reverse_lookup_location(final_loc)
 
-                if final_loc:
-                    return await self.reverse_lookup_location(final_loc)
+
+    def _random_loc_near(self, starting_loc, radius):
+        r_earth = 6378
+        a = np.random.rand() * 2 * math.pi
+        r = radius * math.sqrt(np.random.rand())
+        rand_x = r * math.cos(a)
+        rand_y = r * math.sin(a)
+        new_latitude  = starting_loc.lat + (rand_x / r_earth) * (180 / math.pi)
+        new_longitude = starting_loc.lng + (rand_y / r_earth) * (180 / math.pi) / math.cos(starting_loc.lat * math.pi / 180)
+        return Location(new_latitude, new_longitude)
 
 
     async def find_random_street_view_loc(self, starting_loc, radius):
         attempts = 0
-        r_earth = 6378
+        max_attempts = RADIUS_GROW_CNT * RADIUS_ATTEMPTS
 
         print(f'Attempting to get street view meta near {starting_loc.to_string()}')
 
-        while True:
-            a = np.random.rand() * 2 * math.pi
-            r = radius * math.sqrt(np.random.rand())
-            rand_x = r * math.cos(a)
-            rand_y = r * math.sin(a)
-            new_latitude  = starting_loc.lat + (rand_x / r_earth) * (180 / math.pi)
-            new_longitude = starting_loc.lng + (rand_y / r_earth) * (180 / math.pi) / math.cos(starting_loc.lat * math.pi / 180)
+        try:
+            # Half the time reuse a panorama found near here before, the rest
+            # keep exploring so rounds don't keep landing on the same spots
+            if self.coverage and np.random.rand() < KNOWN_GOOD_CHANCE:
+                loc = self.coverage.sample_near(starting_loc, radius)
+
+                if loc:
+                    print(f'Using known street view near {starting_loc.to_string()} {self.coverage.stats()}')
+                    return loc
+
+            while attempts <= max_attempts:
+                # Points are drawn exactly as they were one at a time, so the
+                # radius still grows every RADIUS_ATTEMPTS points, they are just
+                # probed a wave at a time. Points in cells known to have no
+                # coverage use up an attempt without costing a request
+                wave = []
 
-            loc = await self.check_for_street_view_img(Location(new_latitude, new_longitude))
+                while len(wave) < self.probe_wave_size and attempts <= max_attempts:
+                    loc = self._random_loc_near(starting_loc, radius)
+                    attempts += 1
 
-            if loc:
-                return loc
+                    if attempts % RADIUS_ATTEMPTS == 0:
+                        print('Unable to find suitible location, expanding radius...')
+                        radius = radius * RADIUS_MULTI
 
-            attempts += 1
+                    if not self.coverage or not self.coverage.is_dead(loc):
+                        wave.append(loc)
 
-            if attempts % RADIUS_ATTEMPTS == 0:
-                print('Unable to find suitible location, expanding radius...')
-                radius = radius * RADIUS_MULTI
+                if not wave:
+                    continue
 
-            if attempts > RADIUS_GROW_CNT * RADIUS_ATTEMPTS:
-                print('Unable to find suitible location, changing starting location')
-                return None
+                loc = await self._probe_wave(wave)
+
+                if loc:
+                    print(f'Found street view after {attempts} attempts')
+                    return loc
+
+            print('Unable to find suitible location, changing starting location')
+            return None
+        finally:
+            if self.coverage:
+                print(f'Street view coverage cache {self.coverage.stats()}')
+                await self._save_coverage()
+
+
+    async def _probe_wave(self, locations):
+        pending = {asyncio.ensure_future(self.check_for_street_view_img(l)) for l in locations}
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception():
+                        print(task.exception())
+                        continue
+
+                    if task.result():
+                        return task.result()
+        finally:
+            # First hit wins, the rest of the wave is not worth waiting for
+            for task in pending:
+                task.cancel()
+
+        return None
 
 
     async def check_for_street_view_img(self, location):
         url = location.street_view_meta_url(self.api_token)
 
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(url)
-                resp_json = resp.json()
-
-                if 'status' in resp_json and resp_json['status'].lower() == 'ok':
-                    return Location(
-                        lat=resp_json['location']['lat'],
-                        lng=resp_json['location']['lng'],
-                        heading=location.heading
-                    )
+            resp = await self._client.get(url)
+            resp_json = resp.json()
+
+            status = resp_json.get('status', '').lower()
+
+            if status == 'ok':
+                pano_loc = Location(
+                    lat=resp_json['location']['lat'],
+                    lng=resp_json['location']['lng'],
+                    heading=location.heading
+                )
+
+                if self.coverage:
+                    self.coverage.record_hit(location, pano_loc)
+
+                return pano_loc
+
+            # Only a definite no counts against the cell, quota and auth
+            # errors say nothing about coverage
+            if status == 'zero_results' and self.coverage:
+                self.coverage.record_miss(location)
+        except asyncio.CancelledError:
+            raise
         except:
             raise Exception(f'Unable to get street view metadata for {location.to_string()}')
 
@@ -92,63 +216,40 @@ class StreetView:
         print(f'Attempting to get street view image from {location.to_string()}')
 
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(url)
-                return BytesIO(resp.content)
+            resp = await self._client.get(url)
+            return BytesIO(resp.content)
         except:
             raise Exception(f'Unable to get street view image for {location.to_string()}')
 
 
     async def reverse_lookup_location(self, loc):
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(REV_GEO_API_URL.format(loc.lat, loc.lng, self.api_token))
-            resp_json = resp.json()
+        resp = await self._client.get(REV_GEO_API_URL.format(loc.lat, loc.lng, self.api_token))
+        resp_json = resp.json()
 
-            address_comp = resp_json['results'][0]['address_components']
-            area = next((a['long_name'] for a in address_comp if 'administrative_area_level_1' in a['types']), "None")
-            sub_area = next((a['long_name'] for a in address_comp if 'political' in a['types']), "None")
-            country = next((a['long_name'] for a in address_comp if 'country' in a['types']), "None")
+        address_comp = resp_json['results'][0]['address_components']
+        area = next((a['long_name'] for a in address_comp if 'administrative_area_level_1' in a['types']), "None")
+        sub_area = next((a['long_name'] for a in address_comp if 'political' in a['types']), "None")
+        country = next((a['long_name'] for a in address_comp if 'country' in a['types']), "None")
 
-            loc.add_name_data(
-                country=country,
-                area=area,
-                sub_area=sub_area
-            )
+        loc.add_name_data(
+            country=country,
+            area=area,
+            sub_area=sub_area
+        )
 
-            return loc
+        return loc
 
 
     async def create_img_grid(self, loc):
-        w = (IMG_BORDER * 3) + (IMG_WIDTH * 2)
-        h = (IMG_BORDER * 3) + (IMG_HEIGHT * 2)
-        img = Image.new('RGB', (w, h), (255, 255, 255))
-
-        for i in range(4):
-            new_loc = loc
-            new_loc.heading += 90 * i
+        # Each tile gets its own Location so the caller's heading is left alone
+        headings = [(loc.heading + 90 * i) % 360 for i in range(4)]
+        print(f'Getting images with headings {headings}')
 
-            if new_loc.heading > 360:
-                new_loc.heading = new_loc.heading - 360
-
-            print(f'Getting image with heading {new_loc.heading}')
-
-            img_bytes = await self.get_street_view_img(new_loc)
-            map_img = Image.open(img_bytes)
-
-            if i == 0:
-                img.paste(map_img, (IMG_BORDER, IMG_BORDER))
-            elif i == 1:
-                img.paste(map_img, (IMG_WIDTH + (IMG_BORDER * 2), IMG_BORDER))
-            elif i == 2:
-                img.paste(map_img, (IMG_BORDER, IMG_HEIGHT + (IMG_BORDER * 2)))
-            else:
-                img.paste(map_img, (IMG_WIDTH + (IMG_BORDER * 2), IMG_HEIGHT + (IMG_BORDER * 2)))
-
-        full_img_bytes = BytesIO()
-        img.save(full_img_bytes, format='png')
-        full_img_bytes.seek(0)
+        tiles = await asyncio.gather(*[
+            self.get_street_view_img(Location(loc.lat, loc.lng, heading)) for heading in headings
+        ])
 
-        return full_img_bytes
+        return await asyncio.get_event_loop().run_in_executor(None, compose_img_grid, tiles, self.grid_format, self.grid_quality)
 
 
     def get_distance(self, loc1, loc2):
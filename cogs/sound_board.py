@@ -7,14 +7,21 @@ import discord
 from discord.ext import commands
 from discord.utils import get
 
-from utils.discord_helpers import send_text_list_to_author
+from utils.discord_helpers import TextListCache, send_text_page_to_author
 from utils.discord_helpers import get_channel_from_ctx
 
 
+MAX_SUGGESTIONS = 10
+
+
 class SoundBoard(commands.Cog):
     def __init__(self, bot, sound_files):
         self.bot = bot
         self.sound_files = sound_files
+        self.list_cache = TextListCache(
+            get_version=lambda: self.sound_files.version,
+            get_strings=lambda: [f.name for f in self.sound_files.list_files()]
+        )
 
 
     @commands.command(name='play', help='Play a sound')
@@ -24,8 +31,23 @@ class SoundBoard(commands.Cog):
             channel = get_channel_from_ctx(bot=self.bot, ctx=ctx)
             sound_file = self.sound_files.find(sound_name)
 
+            if not sound_file:
+                matches = self.sound_files.find_prefix(sound_name, limit=MAX_SUGGESTIONS + 1)
+
+                if len(matches) == 1:
+                    sound_file = matches[0]
+                elif matches:
+                    suggestions = ', '.join(f'`{f.name}`' for f in matches[:MAX_SUGGESTIONS])
+                    await ctx.message.author.send(f'Could not find sound `{sound_name}`, did you mean: {suggestions}')
+                    return
+
             if sound_file:
-                await self.bot.voice.play(channel=channel, source=sound_file.get_path(), title=sound_file.name)
+                await self.bot.voice.play(
+                    channel=channel,
+                    source=sound_file.get_path(),
+                    title=sound_file.name,
+                    on_error=lambda e: ctx.message.author.send(f'Failed to play `{sound_name}`')
+                )
             else:
                 await ctx.message.author.send(f'Could not find sound `{sound_name}`')
         except Exception as e:
@@ -36,7 +58,12 @@ class SoundBoard(commands.Cog):
     @commands.command(name='stop', help='Stops all sounds')
     async def stop(self, ctx):
         print(f'Stop audio request from {ctx.message.author}')
-        await self.bot.voice.stop()
+
+        if not ctx.guild:
+            await ctx.message.author.send('Use `!stop` in the server you want to stop sounds in')
+            return
+
+        await self.bot.voice.stop(ctx.guild.id)
 
 
     @commands.command(name='random', help='Random sound')
@@ -45,20 +72,28 @@ class SoundBoard(commands.Cog):
             print(f'Random audio request from {ctx.message.author}')
             channel = get_channel_from_ctx(bot=self.bot, ctx=ctx)
             sound_file = self.sound_files.random()
-            await self.bot.voice.play(channel=channel, source=sound_file.path, title=sound_file.name)
+            await self.bot.voice.play(
+                channel=channel,
+                source=sound_file.path,
+                title=sound_file.name,
+                on_error=lambda e: ctx.message.author.send(f'Failed to play random sound')
+            )
         except Exception as e:
             print(e)
             await ctx.message.author.send(f'Failed to play random sound')
 
 
-    @commands.command(name='list', help='List all sounds')
-    async def list_sounds(self, ctx):
+    @commands.command(name='list', help='List all sounds, optionally filtered by prefix and paged (!list 2, !list prefix 2)')
+    async def list_sounds(self, ctx, prefix=None, page: int=1):
         print(f'List sounds request from {ctx.message.author}')
 
-        filenames = self.sound_files.list_files()
+        if prefix and prefix.isdigit():
+            prefix, page = None, int(prefix)
+
+        pages = self.list_cache.get_pages(prefix)
 
-        if not filenames or len(filenames) == 0:
-            await ctx.message.author.send('There are no audio files')
+        if not pages:
+            await ctx.message.author.send(f'There are no audio files starting with `{prefix}`' if prefix else 'There are no audio files')
             return
 
-        await send_text_list_to_author(ctx, [f.name for f in filenames])
\ No newline at end of file
+        await send_text_page_to_author(ctx, pages, page=page, prefix=prefix)
\ No newline at end of file
@@ -17,6 +17,9 @@ class WhoseThatPokemon(commands.Cog):
         )
         self.current_games = []
 
+        if self.bot.voice.opus_cache:
+            self.bot.voice.opus_cache.watch(self.poke_factory.poke_sounds)
+
 
     @commands.command(name='wtp', help='Start a round of whose that pokemon!')
     async def wtp(self, ctx, guess=None):
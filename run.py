@@ -7,8 +7,11 @@ import logging
 import json
 
 from bot.client import BotClient
+from bot.opus_cache import OpusCache
+from bot.url_cache import UrlCache, URL_CACHE_DIR
 from utils.files import FileRepo
 from utils.users import UserManager
+from utils.image_cache import ImageSearchCache
 from utils.config import Config
 from cogs.sound_board import SoundBoard
 from cogs.entrances import Entrances
@@ -38,6 +41,16 @@ if __name__ == "__main__":
     parser.add_argument('-bucket_sub_name', type=str, help='The project bucket pub/sub subscription name', default=None)
     parser.add_argument('-api_url', type=str, help='The base API url', required=True)
     parser.add_argument('-bucket_path', type=str, help='The base bucket path', required=True)
+    parser.add_argument('-warm_voice', action='store_true', help='Keep voice connections open while channels have listeners and pre-join for entrances')
+    parser.add_argument('-voice_idle_timeout', type=int, help='Seconds of silence before leaving a voice channel', default=300)
+    parser.add_argument('-warm_idle_timeout', type=int, help='Seconds of silence before leaving a voice channel with listeners when -warm_voice is set', default=1800)
+    parser.add_argument('-user_cache_ttl', type=int, help='Seconds before the user cache is refreshed from the API', default=300)
+    parser.add_argument('-img_query_ttl', type=int, help='Seconds an image search result is reused before the API is called again', default=6 * 60 * 60)
+    parser.add_argument('-geo_round_pool', type=int, help='Number of Geo Sniff rounds to keep prepared in the background', default=3)
+    parser.add_argument('-geo_grid_format', type=str, help='Image format for Geo Sniff grids', choices=['png', 'jpeg', 'webp'], default='jpeg')
+    parser.add_argument('-geo_grid_quality', type=int, help='JPEG/WebP quality for Geo Sniff grids', default=85)
+    parser.add_argument('-img_cache_dir', type=str, help='Directory to spill cached images to when they leave memory', default=None)
+    parser.add_argument('-url_cache_dir', type=str, help='Directory to cache audio streamed from urls in', default=URL_CACHE_DIR)
     args = parser.parse_args()
     print(f'Arguments processed: {args}')
 
@@ -53,12 +66,23 @@ if __name__ == "__main__":
         bucket_sub_name=args.bucket_sub_name
     )
 
+    opus_cache = OpusCache()
+    opus_cache.watch(sound_files)
+
     user_manager = UserManager(
-        user_api_url=config.get_api_url('user')
+        user_api_url=config.get_api_url('user'),
+        cache_ttl=args.user_cache_ttl,
+        bulk_api_url=config.get_api_url('user_bulk') if 'user_bulk' in config.api else None
     )
 
     bot = BotClient(
-        user_manager=user_manager
+        user_manager=user_manager,
+        sound_files=sound_files,
+        opus_cache=opus_cache,
+        url_cache=UrlCache(cache_dir=args.url_cache_dir),
+        warm_voice=args.warm_voice,
+        voice_idle_timeout=args.voice_idle_timeout,
+        warm_idle_timeout=args.warm_idle_timeout
     )
 
     bot.add_cog(SoundBoard(
@@ -75,7 +99,11 @@ if __name__ == "__main__":
     bot.add_cog(GoogleImages(
         bot=bot,
         api_token=args.gimg_api_token,
-        api_cx=args.gimg_api_cx
+        api_cx=args.gimg_api_cx,
+        cache=ImageSearchCache(
+            query_ttl=args.img_query_ttl,
+            disk_dir=args.img_cache_dir
+        )
     ))
 
     bot.add_cog(WhoseThatPokemon(
@@ -88,7 +116,10 @@ if __name__ == "__main__":
         bot=bot,
         geo_sniff_api_url=config.get_api_url('geo_sniff'),
         geo_score_api_url=config.get_api_url('geo_score'),
-        google_api_token=args.gimg_api_token
+        google_api_token=args.gimg_api_token,
+        round_pool_size=args.geo_round_pool,
+        grid_format=args.geo_grid_format,
+        grid_quality=args.geo_grid_quality
     ))
 
     bot.add_command(friday)
@@ -1,64 +1,195 @@
-import sys
+import bisect
 
 from io import BytesIO
 from PIL import Image
 
 MSG_CHAR_LIMIT = 2000
+CODE_BLOCK_SIZE = 6
+PAGE_FOOTER_RESERVE = 100
+MAX_CACHED_FILTERS = 64
 MAX_IMG_SIZE_MB = 8
+MAX_IMG_BYTES = MAX_IMG_SIZE_MB * 1024**2
+IMG_SHRINK_PASSES = 5
+IMG_SHRINK_START_QUALITY = 85
+IMG_SHRINK_MIN_QUALITY = 50
 
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp')
+)
 
-async def send_text_list_to_author(ctx, strings):
-    ret = '```'
 
-    for s in sorted(strings):
-        if (len(ret) + len(s) >= MSG_CHAR_LIMIT - 6):
-            r = ret
-            r = f'{r}```'
-            await ctx.author.send(r)
-            ret = '```'
-        else:
-            ret = f'{ret}\n{s}'
+def paginate_text_list(strings, limit=MSG_CHAR_LIMIT - PAGE_FOOTER_RESERVE):
+    pages = []
+    lines = []
+    size = CODE_BLOCK_SIZE
 
-    ret = f'{ret}```'
-    await ctx.author.send(ret)
+    for s in strings:
+        # A single string longer than a page is cut rather than split
+        s = s[:limit - CODE_BLOCK_SIZE - 1]
 
+        if lines and size + len(s) + 1 > limit:
+            pages.append(_render_page(lines))
+            lines = []
+            size = CODE_BLOCK_SIZE
 
-def create_img_bytes(img):
-    bytes_io = BytesIO()
+        lines.append(s)
+        size += len(s) + 1
 
-    try:
-        bytes_io.seek(0)
-        raw_image_data = img.get_raw_data()
-    except:
-        print('There was an issue getting the image')
+    if lines:
+        pages.append(_render_page(lines))
+
+    return pages
+
+
+def _render_page(lines):
+    body = '\n'.join(lines)
+    return f'```\n{body}```'
+
+
+class TextListCache(object):
+    def __init__(self, get_version, get_strings, max_filters=MAX_CACHED_FILTERS):
+        self.get_version = get_version
+        self.get_strings = get_strings
+        self.max_filters = max_filters
+        self.renders = 0
+        self.hits = 0
+        self._version = None
+        self._lines = []
+        self._pages = {}
+
+
+    def _refresh(self):
+        version = self.get_version()
+
+        if version == self._version:
+            return
+
+        self._lines = sorted(self.get_strings())
+        self._pages = {}
+        self._version = version
+
+
+    def get_pages(self, prefix=None) -> list:
+        self._refresh()
+        prefix = prefix or ''
+
+        if prefix in self._pages:
+            self.hits += 1
+            return self._pages[prefix]
+
+        start = bisect.bisect_left(self._lines, prefix)
+        end = bisect.bisect_left(self._lines, prefix + '\uffff', lo=start)
+
+        if len(self._pages) >= self.max_filters:
+            del self._pages[next(iter(self._pages))]
+
+        self.renders += 1
+        self._pages[prefix] = paginate_text_list(self._lines[start:end])
+        return self._pages[prefix]
+
+
+async def send_text_page_to_author(ctx, pages, page=1, prefix=None):
+    if page < 1 or page > len(pages):
+        await ctx.author.send(f'There is no page {page}, there are {len(pages)} pages')
+        return
+
+    msg = pages[page - 1]
+
+    if len(pages) > 1:
+        footer = f'Page {page}/{len(pages)}'
+
+        if page < len(pages):
+            next_cmd = ' '.join(a for a in (f'{ctx.prefix}{ctx.invoked_with}', prefix, str(page + 1)) if a)
+            footer = f'{footer}, use `{next_cmd}` for the next page'
+
+        if len(msg) + len(footer) + 1 <= MSG_CHAR_LIMIT:
+            msg = f'{msg}\n{footer}'
+
+    await ctx.author.send(msg)
+
+
+def sniff_image_type(data):
+    for signature, ext in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return ext
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+
+    return None
+
+
+# Blocks while Pillow decodes and encodes, so run it in an executor. Returns
+# (bytes, ext) that fit in a Discord upload, or None if it isn't an image or
+# could not be brought under the limit
+def create_img_bytes(img_bytes, max_bytes=MAX_IMG_BYTES):
+    ext = sniff_image_type(img_bytes)
+
+    if not ext:
+        print('Image test failed, this is not an image')
         return None
 
+    if len(img_bytes) <= max_bytes:
+        return img_bytes, ext
+
     try:
-        print('Testing image...')
-        _ = raw_image_data.decode('utf-8')
-        print('Image test failed, this is not an image')
+        return shrink_img_bytes(img_bytes, max_bytes)
+    except Exception as e:
+        print(f'Unable to shrink image - {e}')
         return None
-    except:
-        img.copy_to(bytes_io, raw_image_data)
-        img.copy_to(bytes_io)
-        bytes_io.seek(0)
 
-        img_size = sys.getsizeof(bytes_io)
 
-        if img_size < MAX_IMG_SIZE_MB * (4**10):
-            print('Image is valid')
-            return bytes_io
+def shrink_img_bytes(img_bytes, max_bytes=MAX_IMG_BYTES, max_passes=IMG_SHRINK_PASSES):
+    img = Image.open(BytesIO(img_bytes))
+    img.load()
+
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    size = len(img_bytes)
+    scale = 1.0
+    quality = IMG_SHRINK_START_QUALITY
+
+    for i in range(max_passes):
+        resized = img
+
+        if scale < 1.0:
+            resized = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+
+        bytes_io = BytesIO()
+
+        # Transparent images stay PNG so they keep their alpha, everything
+        # else is re-encoded as JPEG which gives far more control over size
+        if has_alpha:
+            resized.save(bytes_io, format='PNG', optimize=True)
+            ext = 'png'
         else:
-            print(f'Image ({img_size}) is larger than {MAX_IMG_SIZE_MB * (4**10)}')
-            return None
+            resized.save(bytes_io, format='JPEG', quality=quality, optimize=True)
+            ext = 'jpg'
+
+        size = bytes_io.tell()
+        print(f'Image shrink pass {i + 1}: {resized.width}x{resized.height} q{quality} {size} bytes')
+
+        if size <= max_bytes:
+            return bytes_io.getvalue(), ext
+
+        # Encoded size roughly follows the pixel count, so scale the sides by
+        # the square root of how far over we are with a little headroom
+        scale *= min(0.9, (max_bytes / size) ** 0.5 * 0.95)
+        quality = max(IMG_SHRINK_MIN_QUALITY, quality - 10)
+
+    print(f'Image ({size}) is still larger than {max_bytes} after {max_passes} passes')
+    return None
 
 
 def get_channel_from_user(bot, user):
-    for g in bot.guilds:
-        for c in g.voice_channels:
-            for m in c.members:
-                if m.id == user.id:
-                    return c
+    channel = bot.voice_index.get_channel(user.id)
+
+    if channel:
+        return channel
 
     raise Exception(f'User {user.name} is not in a voice channel')
 
@@ -76,10 +207,9 @@ def get_channel_from_ctx(bot, ctx):
 
 
 def get_channel_from_user_id(bot, user_id):
-    for g in bot.guilds:
-        for c in g.voice_channels:
-            for m in c.members:
-                if m.id == int(user_id):
-                    return c
+    channel = bot.voice_index.get_channel(user_id)
+
+    if channel:
+        return channel
 
     raise Exception(f'User {user_id} is not in a voice channel')
\ No newline at end of file
@@ -1,16 +1,25 @@
 import os
+import json
+import time
 import random
+import bisect
+import threading
 
 from google.cloud import storage
 from google.cloud import pubsub_v1
 
-from utils.gcs_helpers import connect_to_bucket, download_file, download_files, list_files, generate_url
+from utils.gcs_helpers import connect_to_bucket, download_file, download_files, list_files, load_manifest, SignedUrlCache
+
+REPO_MANIFEST_FILENAME = '.repo_manifest.json'
 
 class FileObject:
-    def __init__(self, path, bucket=None):
+    __slots__ = ('path', 'name', 'bucket', 'url_cache')
+
+    def __init__(self, path, bucket=None, url_cache=None):
         self.path = path
         self.name = self._remove_extension(path)
         self.bucket = bucket
+        self.url_cache = url_cache
 
     def _remove_extension(self, file_path):
         filename = os.path.split(file_path)[-1]
@@ -18,7 +27,7 @@ class FileObject:
 
     def get_path(self):
         if self.bucket:
-            return generate_url(self.bucket, self.path)
+            return self.url_cache.get_url(self.bucket, self.path)
 
         return self.path
 
@@ -30,6 +39,18 @@ class FileRepo:
 
         self.base_path = base_path
         self.bucket_path = bucket_path
+        self.bucket = None
+        self.url_cache = SignedUrlCache()
+        self.timings = {}
+        self.version = 0
+        self._lock = threading.RLock()
+        self._index = {}
+        self._names = []
+        self._manifest = {}
+        self._listeners = []
+        self._subscription = None
+
+        start = time.perf_counter()
 
         if self.base_path and not os.path.exists(self.base_path):
             os.makedirs(self.base_path)
@@ -44,30 +65,174 @@ class FileRepo:
             if not self.bucket:
                 raise Exception('Unable to connect to GCS bucket')
 
-            if self.base_path:
-                print(f'Downloading the latest files from {self.bucket_path}')
-                download_files(
-                    bucket=self.bucket,
-                    bucket_path=self.bucket_dir,
-                    output_path=self.base_path,
-                    overwrite=False
-                )
+            # Subscribed once the first reconcile has finished, so bucket events
+            # never race the mirror. Pub/Sub holds them until then
+            if self.base_path and project_id and bucket_sub_name:
+                self._subscription = (project_id, bucket_sub_name)
+
+        manifest = self._load_repo_manifest()
 
-                if project_id and bucket_sub_name:
-                    self.subscribe_to_bucket(
-                        project_id=project_id,
-                        bucket_sub_name=bucket_sub_name
-                    )
+        if manifest is not None:
+            # Files removed while the bot was down are left out rather than
+            # served until the reconcile catches up
+            manifest = {f: e for f, e in manifest.items() if os.path.isfile(os.path.join(self.base_path, f))}
+            self._manifest = manifest
+            self._build_index([FileObject(os.path.join(self.base_path, f)) for f in manifest])
+            self.timings['warm_start'] = time.perf_counter() - start
 
-        self.files = self._cache_file_paths()
+            threading.Thread(target=self._background_reconcile, daemon=True).start()
+        else:
+            self._reconcile()
+            self.timings['cold_start'] = time.perf_counter() - start
+
+        startup = ', '.join(f'{k} {v:.2f}s' for k, v in self.timings.items())
+        print(f'File repo {self.base_path or self.bucket_path} loaded {len(self._index)} files ({startup})')
+
+
+    @property
+    def files(self):
+        with self._lock:
+            return [self._index[n] for n in self._names]
 
 
     def _cache_file_paths(self):
         if self.base_path:
-            return [FileObject(os.path.join(self.base_path, f)) for f in os.listdir(self.base_path)]
+            return [FileObject(os.path.join(self.base_path, f)) for f in os.listdir(self.base_path) if not f.startswith('.')]
 
         if self.bucket:
-            return [FileObject(f, self.bucket) for f in list_files(self.bucket, self.bucket_dir)]
+            return [FileObject(f, self.bucket, self.url_cache) for f in list_files(self.bucket, self.bucket_dir)]
+
+
+    def _reconcile(self):
+        start = time.perf_counter()
+
+        if self.bucket and self.base_path:
+            print(f'Downloading the latest files from {self.bucket_path}')
+            download_files(
+                bucket=self.bucket,
+                bucket_path=self.bucket_dir,
+                output_path=self.base_path,
+                overwrite=False
+            )
+
+        if self.base_path:
+            with self._lock:
+                file_objs = self._cache_file_paths()
+                bucket_manifest = load_manifest(self.base_path)
+                self._manifest = {os.path.split(f.path)[-1]: self._manifest_entry(f.path, bucket_manifest) for f in file_objs}
+                self._build_index(file_objs)
+                self._save_repo_manifest()
+        else:
+            self._build_index(self._cache_file_paths())
+
+        self.timings['reconcile'] = time.perf_counter() - start
+        print(f'File repo {self.base_path or self.bucket_path} reconciled {len(self._index)} files in {self.timings["reconcile"]:.2f}s')
+        self._notify('sync')
+        self._start_subscription()
+
+
+    # A failed warm start reconcile keeps serving the manifest index, bucket
+    # events still need to be picked up so it doesn't go stale for good
+    def _background_reconcile(self):
+        try:
+            self._reconcile()
+        except Exception as e:
+            print(f'File repo {self.base_path or self.bucket_path} failed to reconcile, serving the last manifest - {e}')
+            self._start_subscription()
+
+
+    def _start_subscription(self):
+        if not self._subscription:
+            return
+
+        project_id, bucket_sub_name = self._subscription
+        self._subscription = None
+        self.subscribe_to_bucket(
+            project_id=project_id,
+            bucket_sub_name=bucket_sub_name
+        )
+
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+
+    def _notify(self, event, file_obj=None):
+        for callback in self._listeners:
+            try:
+                callback(event, file_obj)
+            except Exception as e:
+                print(f'File repo listener failed on {event} - {e}')
+
+
+    def _manifest_entry(self, file_path, bucket_manifest=None):
+        stat = os.stat(file_path)
+        filename = os.path.split(file_path)[-1]
+        bucket_entry = (bucket_manifest or {}).get(filename, {})
+
+        return {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'generation': bucket_entry.get('generation')
+        }
+
+
+    def _load_repo_manifest(self):
+        if not self.base_path:
+            return None
+
+        manifest_path = os.path.join(self.base_path, REPO_MANIFEST_FILENAME)
+
+        if not os.path.isfile(manifest_path):
+            return None
+
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)
+        except ValueError:
+            print(f'Ignoring corrupt file repo manifest {manifest_path}')
+            return None
+
+
+    def _save_repo_manifest(self):
+        manifest_path = os.path.join(self.base_path, REPO_MANIFEST_FILENAME)
+        tmp_path = f'{manifest_path}.part'
+
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._manifest, f)
+
+            os.replace(tmp_path, manifest_path)
+
+
+    def _build_index(self, file_objs):
+        with self._lock:
+            self._index = {f.name: f for f in file_objs}
+            names = sorted(self._index)
+
+            # A reconcile that finds nothing new keeps cached listings valid
+            if names != self._names:
+                self._names = names
+                self.version += 1
+
+
+    def _index_file(self, fo):
+        with self._lock:
+            if fo.name not in self._index:
+                bisect.insort(self._names, fo.name)
+                self.version += 1
+
+            self._index[fo.name] = fo
+
+
+    def _unindex_file(self, name):
+        with self._lock:
+            if self._index.pop(name, None) is None:
+                return
+
+            i = bisect.bisect_left(self._names, name)
+            del self._names[i]
+            self.version += 1
 
 
     def add_file(self, filename):
@@ -78,7 +243,13 @@ class FileRepo:
             return None
 
         fo = FileObject(file_path)
-        self.files.append(fo)
+
+        with self._lock:
+            self._index_file(fo)
+            self._manifest[filename] = self._manifest_entry(file_path, load_manifest(self.base_path))
+            self._save_repo_manifest()
+
+        self._notify('add', fo)
         return fo
 
 
@@ -89,15 +260,34 @@ class FileRepo:
             print(f'Unable to delete file - {filename} not found')
             return
 
-        self.files = [f for f in self.files if f.path != file_path]
+        fo = FileObject(file_path)
+
+        with self._lock:
+            self._unindex_file(fo.name)
+            self._manifest.pop(filename, None)
+            self._save_repo_manifest()
+
+        self._notify('delete', fo)
 
 
     def find(self, name) -> object:
-        return next((f for f in self.files if f.name == name), None)
+        return self._index.get(name)
+
+
+    def find_prefix(self, prefix, limit=None) -> list:
+        with self._lock:
+            start = bisect.bisect_left(self._names, prefix)
+            end = bisect.bisect_left(self._names, prefix + '\uffff', lo=start)
+
+            if limit is not None:
+                end = min(end, start + limit)
+
+            return [self._index[n] for n in self._names[start:end]]
 
 
     def random(self) -> object:
-        return random.choice(self.files)
+        with self._lock:
+            return self._index[random.choice(self._names)]
 
 
     def list_files(self) -> list:
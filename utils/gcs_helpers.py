@@ -1,8 +1,30 @@
 import os
+import json
+import time
+import base64
+import hashlib
+import threading
 
 from tqdm import tqdm
 from google.cloud import storage
 from datetime import timezone, datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+MANIFEST_FILENAME = '.gcs_manifest.json'
+MIRROR_WORKERS = 8
+MANIFEST_SAVE_EVERY = 10
+HASH_CHUNK_SIZE = 1024 * 1024
+SIGNED_URL_LIFETIME = 3600
+SIGNED_URL_REFRESH_MARGIN = 300
+SIGNED_URL_CACHE_SIZE = 1024
+
+_manifest_lock = threading.RLock()
 
 def connect_to_bucket(bucket_name):
     storage_client = storage.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'])
@@ -12,9 +34,9 @@ def connect_to_bucket(bucket_name):
 
 def download_file(bucket, bucket_path, filename, output_path, overwrite=False):
     bucket_path_full = os.path.join(bucket_path, filename)
-    blob = bucket.blob(bucket_path_full)
+    blob = bucket.get_blob(bucket_path_full)
 
-    if not blob.exists():
+    if not blob:
         print(f'File {bucket_path_full} does not exist in the bucket')
         return
 
@@ -28,38 +50,166 @@ def download_file(bucket, bucket_path, filename, output_path, overwrite=False):
        print(f'File download failed - File {full_path} exists and overwrite is set to False')
        return
 
-    blob.download_to_filename(full_path)
+    _download_blob(blob, full_path)
+    update_manifest(output_path, {filename: _blob_entry(blob)})
 
 
-def download_files(bucket, bucket_path, output_path, overwrite=False):
+def download_files(bucket, bucket_path, output_path, overwrite=False, workers=MIRROR_WORKERS):
     blobs = bucket.list_blobs(prefix=bucket_path)
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    current_files = [] if overwrite else os.listdir(output_path)
+    _remove_partial_downloads(output_path)
+    manifest = {} if overwrite else load_manifest(output_path)
 
-    print(f'Downloading all files from {bucket_path} to {output_path}')
+    print(f'Mirroring all files from {bucket_path} to {output_path}')
     files_to_download = []
     for blob in blobs:
         if blob.name[-1] != '/':
             _, tail = os.path.split(blob.name)
+            full_path = os.path.join(output_path, tail)
 
-            if not overwrite and any(tail == fn for fn in current_files):
+            if not overwrite and _is_current(blob, manifest.get(tail), full_path):
+                manifest[tail] = _blob_entry(blob)
                 continue
 
-            full_path = os.path.join(output_path, tail)
-            files_to_download.append((blob, full_path))
+            files_to_download.append((blob, tail, full_path))
 
     if len(files_to_download):
-        for f in tqdm(files_to_download):
-            blob, full_path = f
-            blob.download_to_filename(full_path)
+        lock = threading.Lock()
+        completed = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(files_to_download)) as progress:
+            futures = {executor.submit(_download_blob, blob, full_path): (blob, tail) for blob, tail, full_path in files_to_download}
+
+            for future in as_completed(futures):
+                blob, tail = futures[future]
+                progress.update(1)
+
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Failed to download {blob.name} - {e}')
+                    continue
+
+                with lock:
+                    manifest[tail] = _blob_entry(blob)
+                    completed += 1
+
+                    if completed % MANIFEST_SAVE_EVERY == 0:
+                        update_manifest(output_path, manifest)
 
         print(f'{bucket_path} download complete')
     else:
         print(f'{bucket_path} had no files to download!')
 
+    if overwrite:
+        save_manifest(output_path, manifest)
+        return manifest
+
+    return update_manifest(output_path, manifest)
+
+
+def load_manifest(output_path):
+    manifest_path = os.path.join(output_path, MANIFEST_FILENAME)
+
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except ValueError:
+        print(f'Ignoring corrupt manifest {manifest_path}')
+        return {}
+
+
+def save_manifest(output_path, manifest):
+    manifest_path = os.path.join(output_path, MANIFEST_FILENAME)
+    tmp_path = f'{manifest_path}.{os.getpid()}.{threading.get_ident()}.part'
+
+    with _manifest_lock:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+
+        os.replace(tmp_path, manifest_path)
+
+
+# Merges entries into the manifest on disk, so a mirror and single file
+# downloads running at the same time don't drop each other's entries
+def update_manifest(output_path, entries):
+    with _manifest_lock:
+        manifest = load_manifest(output_path)
+        manifest.update(entries)
+        save_manifest(output_path, manifest)
+        return manifest
+
+
+def _download_blob(blob, full_path):
+    head, tail = os.path.split(full_path)
+    tmp_path = os.path.join(head, f'.{tail}.part')
+
+    try:
+        blob.download_to_filename(tmp_path)
+        os.replace(tmp_path, full_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _remove_partial_downloads(output_path):
+    for f in os.listdir(output_path):
+        if f.startswith('.') and f.endswith('.part'):
+            os.remove(os.path.join(output_path, f))
+
+
+def _blob_entry(blob):
+    return {
+        'size': blob.size,
+        'md5': blob.md5_hash,
+        'crc32c': blob.crc32c,
+        'generation': blob.generation
+    }
+
+
+def _is_current(blob, entry, full_path):
+    if not os.path.isfile(full_path) or os.path.getsize(full_path) != blob.size:
+        return False
+
+    if entry:
+        return entry.get('md5') == blob.md5_hash and entry.get('crc32c') == blob.crc32c
+
+    # No manifest entry, either an old volume or an interrupted sync, so
+    # check the local copy against the bucket checksums before trusting it
+    if blob.md5_hash:
+        return _file_md5(full_path) == blob.md5_hash
+
+    if blob.crc32c and google_crc32c:
+        return _file_crc32c(full_path) == blob.crc32c
+
+    return False
+
+
+def _file_md5(full_path):
+    md5 = hashlib.md5()
+
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            md5.update(chunk)
+
+    return base64.b64encode(md5.digest()).decode('utf-8')
+
+
+def _file_crc32c(full_path):
+    crc = google_crc32c.Checksum()
+
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            crc.update(chunk)
+
+    return base64.b64encode(crc.digest()).decode('utf-8')
+
 
 def upload_file(bucket, source_path, bucket_path, filename):
     print(f'Uploading {source_path} to {bucket_path}')
@@ -72,7 +222,66 @@ def list_files(bucket, bucket_path):
     return [b.name for b in filter(lambda x: x.name[-1] != '/', blobs)]
 
 
-def generate_url(bucket, bucket_path):
+def generate_url(bucket, bucket_path, lifetime=SIGNED_URL_LIFETIME):
     blob = bucket.blob(bucket_path)
-    url_lifetime = int(datetime.now(tz=timezone.utc).timestamp()) + 3600
-    return blob.generate_signed_url(url_lifetime)
\ No newline at end of file
+    url_lifetime = int(datetime.now(tz=timezone.utc).timestamp()) + lifetime
+    return blob.generate_signed_url(url_lifetime)
+
+
+class SignedUrlCache:
+    def __init__(self, max_entries=SIGNED_URL_CACHE_SIZE, lifetime=SIGNED_URL_LIFETIME, refresh_margin=SIGNED_URL_REFRESH_MARGIN):
+        if refresh_margin >= lifetime:
+            raise Exception('Signed URL refresh margin must be shorter than the URL lifetime')
+
+        self.max_entries = max_entries
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.signs = 0
+        self.evictions = 0
+        self.sign_time = 0.0
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get_url(self, bucket, bucket_path):
+        key = (bucket.name, bucket_path)
+        now = time.time()
+
+        with self._lock:
+            cached = self._urls.get(key)
+
+            if cached and cached[1] - self.refresh_margin > now:
+                self._urls.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+
+        start = time.perf_counter()
+        url = generate_url(bucket, bucket_path, self.lifetime)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.signs += 1
+            self.sign_time += elapsed
+            self._urls[key] = (url, now + self.lifetime)
+            self._urls.move_to_end(key)
+
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+                self.evictions += 1
+
+        return url
+
+
+    def stats(self):
+        with self._lock:
+            avg_sign_time = self.sign_time / self.signs if self.signs else 0
+
+            return {
+                'entries': len(self._urls),
+                'hits': self.hits,
+                'signs': self.signs,
+                'evictions': self.evictions,
+                'avg_sign_ms': avg_sign_time * 1000,
+                'saved_sign_ms': self.hits * avg_sign_time * 1000
+            }
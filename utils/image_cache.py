@@ -0,0 +1,235 @@
+import os
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+IMG_QUERY_TTL = 6 * 60 * 60
+IMG_QUERY_CACHE_SIZE = 256
+IMG_BAD_URL_CACHE_SIZE = 1024
+IMG_CACHE_MAX_BYTES = 64 * 1024**2
+IMG_DISK_CACHE_MAX_BYTES = 512 * 1024**2
+
+
+class ImageSearchCache:
+    def __init__(self, query_ttl=IMG_QUERY_TTL, max_queries=IMG_QUERY_CACHE_SIZE, max_bytes=IMG_CACHE_MAX_BYTES,
+                 disk_dir=None, disk_max_bytes=IMG_DISK_CACHE_MAX_BYTES):
+        self.query_ttl = query_ttl
+        self.max_queries = max_queries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.query_hits = 0
+        self.query_misses = 0
+        self.image_hits = 0
+        self.disk_hits = 0
+        self.image_misses = 0
+        self.bytes_saved = 0
+        self._queries = OrderedDict()
+        self._bad_urls = OrderedDict()
+        self._images = OrderedDict()
+        self._image_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        if self.disk_dir:
+            self._load_disk_index()
+
+
+    def _query_key(self, query):
+        return ' '.join(query.lower().split())
+
+
+    def get_urls(self, query):
+        key = self._query_key(query)
+
+        with self._lock:
+            cached = self._queries.get(key)
+
+            if cached and cached[1] > time.time():
+                self._queries.move_to_end(key)
+                self.query_hits += 1
+                return [url for url in cached[0] if url not in self._bad_urls]
+
+            self.query_misses += 1
+            return None
+
+
+    def add_urls(self, query, urls):
+        with self._lock:
+            key = self._query_key(query)
+            self._queries[key] = (list(urls), time.time() + self.query_ttl)
+            self._queries.move_to_end(key)
+
+            while len(self._queries) > self.max_queries:
+                self._queries.popitem(last=False)
+
+
+    # Urls that served an error page are skipped on later hits for the same query
+    def mark_bad(self, url):
+        with self._lock:
+            self._bad_urls[url] = True
+            self._bad_urls.move_to_end(url)
+
+            while len(self._bad_urls) > IMG_BAD_URL_CACHE_SIZE:
+                self._bad_urls.popitem(last=False)
+
+
+    # The disk tier blocks, so call these from an executor when it is enabled
+    def get_image(self, url):
+        with self._lock:
+            cached = self._images.get(url)
+
+            if cached:
+                self._images.move_to_end(url)
+                self.image_hits += 1
+                self.bytes_saved += len(cached[0])
+                return cached
+
+        cached = self._read_disk(url)
+
+        with self._lock:
+            if cached:
+                self.disk_hits += 1
+                self.bytes_saved += len(cached[0])
+            else:
+                self.image_misses += 1
+
+        if cached:
+            self.add_image(url, *cached)
+
+        return cached
+
+
+    def add_image(self, url, img_bytes, ext):
+        evicted = []
+
+        with self._lock:
+            if url in self._images:
+                self._image_bytes -= len(self._images.pop(url)[0])
+
+            self._images[url] = (img_bytes, ext)
+            self._image_bytes += len(img_bytes)
+
+            while self._image_bytes > self.max_bytes and len(self._images) > 1:
+                old_url, old = self._images.popitem(last=False)
+                self._image_bytes -= len(old[0])
+                evicted.append((old_url, old))
+
+        # Images pushed out of memory spill to disk so they can still be served
+        # without another download
+        for old_url, old in evicted:
+            self._write_disk(old_url, *old)
+
+
+    def _disk_key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            key, ext = os.path.splitext(entry.name)
+            entries.append((stat.st_mtime, key, ext[1:], stat.st_size))
+
+        for _, key, ext, size in sorted(entries):
+            self._disk[key] = (ext, size)
+            self._disk_bytes += size
+
+
+    def _disk_path(self, key, ext):
+        return os.path.join(self.disk_dir, f'{key}.{ext}')
+
+
+    def _read_disk(self, url):
+        if not self.disk_dir:
+            return None
+
+        key = self._disk_key(url)
+
+        with self._lock:
+            entry = self._disk.get(key)
+
+            if not entry:
+                return None
+
+            self._disk.move_to_end(key)
+
+        try:
+            with open(self._disk_path(key, entry[0]), 'rb') as f:
+                return f.read(), entry[0]
+        except OSError:
+            with self._lock:
+                if self._disk.pop(key, None):
+                    self._disk_bytes -= entry[1]
+            return None
+
+
+    def _write_disk(self, url, img_bytes, ext):
+        if not self.disk_dir:
+            return
+
+        key = self._disk_key(url)
+        path = self._disk_path(key, ext)
+
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                return
+
+        try:
+            tmp_path = os.path.join(self.disk_dir, f'.{key}.part')
+
+            with open(tmp_path, 'wb') as f:
+                f.write(img_bytes)
+
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'Unable to spill image {url} to disk - {e}')
+            return
+
+        removed = []
+
+        with self._lock:
+            self._disk[key] = (ext, len(img_bytes))
+            self._disk_bytes += len(img_bytes)
+
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                old_key, (old_ext, old_size) = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                removed.append(self._disk_path(old_key, old_ext))
+
+        for old_path in removed:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+
+    def stats(self):
+        with self._lock:
+            queries = self.query_hits + self.query_misses
+            images = self.image_hits + self.disk_hits + self.image_misses
+
+            return {
+                'queries': len(self._queries),
+                'query_hits': self.query_hits,
+                'query_misses': self.query_misses,
+                'query_hit_rate': self.query_hits / queries if queries else 0,
+                'api_calls_saved': self.query_hits,
+                'images': len(self._images),
+                'image_bytes': self._image_bytes,
+                'disk_images': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'image_hits': self.image_hits,
+                'disk_hits': self.disk_hits,
+                'image_misses': self.image_misses,
+                'image_hit_rate': (self.image_hits + self.disk_hits) / images if images else 0,
+                'bytes_saved': self.bytes_saved
+            }
@@ -1,9 +1,16 @@
 import os
+import time
 import random
 import json
-import requests
+import asyncio
+import httpx
 
 HEADERS = {'Content-type':'application/json', 'Accept':'application/json'}
+USER_CACHE_TTL = 300
+USER_API_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+USER_API_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+USER_SYNC_CONCURRENCY = 10
+USER_SYNC_BATCH_SIZE = 100
 
 class BotUser(object):
     def __init__(self, user_id: str, user_name: str, entrance_filename:str=None):
@@ -16,15 +23,95 @@ class BotUser(object):
 
 
 class UserManager():
-    def __init__(self, user_api_url):
+    def __init__(self, user_api_url, cache_ttl=USER_CACHE_TTL, bulk_api_url=None):
         self.user_api_url = user_api_url
-        self._load_users()
+        self.bulk_api_url = bulk_api_url
+        self.cache_ttl = cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.version = 0
+        self._users = {}
+        self._loaded_on = 0
+        self._load_lock = asyncio.Lock()
+        self._client = httpx.AsyncClient(
+            headers=HEADERS,
+            timeout=USER_API_TIMEOUT,
+            limits=USER_API_LIMITS
+        )
 
 
-    def _load_users(self):
-        response = requests.get(self.user_api_url, headers=HEADERS)
-        users_json = response.json()
-        self.users = [BotUser(user_id=u['discordId'], user_name=u['name'], entrance_filename=u['entranceSound']) for u in users_json]
+    @property
+    def users(self):
+        return list(self._users.values())
+
+
+    async def load(self):
+        async with self._load_lock:
+            await self._load_users()
+
+
+    async def close(self):
+        await self._client.aclose()
+
+
+    def _cache_key(self, user_id):
+        return str(user_id)
+
+
+    def _cache_user(self, user):
+        self._users[self._cache_key(user.user_id)] = user
+        self.version += 1
+        return user
+
+
+    def _fingerprint(self):
+        return {k: (u.user_name, u.entrance_filename) for k, u in self._users.items()}
+
+
+    def _is_stale(self):
+        return self.cache_ttl and time.monotonic() - self._loaded_on > self.cache_ttl
+
+
+    async def _load_users(self):
+        response = await self._client.get(self.user_api_url)
+        response.raise_for_status()
+        users = {}
+
+        for u in response.json():
+            user = self._user_from_json(u)
+            users[self._cache_key(user.user_id)] = user
+
+        before = self._fingerprint()
+        self._users = users
+
+        # Periodic reloads usually return the same users, only bump the
+        # version when a name or entrance actually changed
+        if self._fingerprint() != before:
+            self.version += 1
+
+        self._loaded_on = time.monotonic()
+
+
+    # A failed refresh keeps serving the cached users until the next TTL,
+    # rather than every voice event retrying the full reload
+    async def _refresh_users(self):
+        async with self._load_lock:
+            if not self._is_stale():
+                return
+
+            try:
+                await self._load_users()
+            except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+                print(f'Unable to refresh users, keeping {len(self._users)} cached users - {e}')
+                self._loaded_on = time.monotonic()
+
+
+    def _user_from_json(self, user_json):
+        return BotUser(
+            user_id=user_json['discordId'],
+            user_name=user_json['name'],
+            entrance_filename=user_json['entranceSound']
+        )
 
 
     def _create_request(self, user):
@@ -35,46 +122,138 @@ class UserManager():
         }
 
 
-    def add_user(self, user_id, user_name):
-        req = self._create_request(BotUser(user_id=user_id, user_name=user_name))
-        requests.post(self.user_api_url, data=json.dumps(req), headers=HEADERS)
-        self._load_users()
+    async def add_user(self, user_id, user_name):
+        user = BotUser(user_id=user_id, user_name=user_name)
+        return await self._write_user('POST', user)
+
+
+    async def add_users(self, bot_users):
+        await self.sync_users(new_users=bot_users, updated_users=[], reload=False)
+
+
+    # Returns the users that could not be sent. One failed request doesn't
+    # stop the rest of the sync, failures are logged and left out of the cache
+    async def sync_users(self, new_users, updated_users, reload=True):
+        if self.bulk_api_url:
+            failed = await self._send_bulk('POST', new_users)
+            failed += await self._send_bulk('PUT', updated_users)
+        else:
+            sem = asyncio.Semaphore(USER_SYNC_CONCURRENCY)
+            sends = [('POST', u) for u in new_users] + [('PUT', u) for u in updated_users]
+            results = await asyncio.gather(
+                *[self._send_user(sem, method, u) for method, u in sends],
+                return_exceptions=True
+            )
+            failed = []
 
+            for (method, user), result in zip(sends, results):
+                if isinstance(result, Exception):
+                    print(f'Unable to {method} user {user.user_id} - {result}')
+                    failed.append(user)
 
-    def add_users(self, bot_users):
-        for user in bot_users:
+        if reload:
+            await self.load()
+        else:
+            failed_ids = {id(u) for u in failed}
+
+            for user in new_users + updated_users:
+                if id(user) not in failed_ids:
+                    self._cache_user(user)
+
+        return failed
+
+
+    async def _send_user(self, sem, method, user):
+        async with sem:
             req = self._create_request(user)
-            requests.post(self.user_api_url, data=json.dumps(req), headers=HEADERS)
-        self._load_users()
+            response = await self._client.request(method, self.user_api_url, content=json.dumps(req))
+            response.raise_for_status()
+
+
+    async def _send_bulk(self, method, bot_users):
+        failed = []
 
+        for i in range(0, len(bot_users), USER_SYNC_BATCH_SIZE):
+            batch = bot_users[i:i + USER_SYNC_BATCH_SIZE]
+            req = [self._create_request(u) for u in batch]
 
-    def add_entrance(self, user_id, entrance_sound):
-        user = self.get_user(user_id)
+            try:
+                response = await self._client.request(method, self.bulk_api_url, content=json.dumps(req))
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                print(f'Unable to {method} {len(batch)} users - {e}')
+                failed += batch
+
+        return failed
+
+
+    async def add_entrance(self, user_id, entrance_sound):
+        user = await self.get_user(user_id)
 
         if not user:
-            return
+            return False
 
+        # Updates a copy so the cached user is untouched if the write fails
+        user = BotUser(user_id=user.user_id, user_name=user.user_name)
         user.add_entrance(entrance_sound)
-        self.update_user(user)
+        return await self.update_user(user)
 
 
-    def get_user(self, user_id):
-        response = requests.get(f'{self.user_api_url}/{user_id}', headers=HEADERS)
+    def get_cached_user(self, user_id):
+        return self._users.get(self._cache_key(user_id))
 
-        if response.status_code != 404 and response.status_code != 400:
-            response_json = response.json()
 
-            return BotUser(
-                 user_id=response_json['discordId'],
-                 user_name=response_json['name'],
-                 entrance_filename=response_json['entranceSound']
-            )
+    async def get_user(self, user_id):
+        if self._is_stale():
+            await self._refresh_users()
+
+        user = self._users.get(self._cache_key(user_id))
+
+        if user:
+            self.cache_hits += 1
+            return user
+
+        self.cache_misses += 1
+        return await self._fetch_user(user_id)
+
+
+    async def _fetch_user(self, user_id):
+        response = await self._client.get(f'{self.user_api_url}/{user_id}')
+
+        if response.status_code != 404 and response.status_code != 400:
+            return self._cache_user(self._user_from_json(response.json()))
         else:
             print(f'User {user_id} cannot be found')
             return None
 
 
-    def update_user(self, user):
+    async def update_user(self, user):
+        return await self._write_user('PUT', user)
+
+
+    # Only caches the user once the API has accepted the write, returns
+    # whether it did
+    async def _write_user(self, method, user):
         req = self._create_request(user)
-        response = requests.put(self.user_api_url, data=json.dumps(req), headers=HEADERS)
-        self._load_users()
\ No newline at end of file
+
+        try:
+            response = await self._client.request(method, self.user_api_url, content=json.dumps(req))
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f'Unable to {method} user {user.user_id} - {e}')
+            return False
+
+        self._cache_user(user)
+        return True
+
+
+    def cache_stats(self):
+        total = self.cache_hits + self.cache_misses
+        hit_rate = self.cache_hits / total if total else 0
+
+        return {
+            'users': len(self._users),
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': hit_rate
+        }
@@ -3,6 +3,7 @@ export class BrowserClient {
         this._address = address;
         this._port = port;
         this._client = null;
+        this._nextId = 1;
     }
 
     connect(onmessage, onopen) {
@@ -17,6 +18,12 @@ export class BrowserClient {
         this._client.send(message);
     }
 
+    sendRequest(req) {
+        req['id'] = this._nextId++;
+        this.sendMessage(JSON.stringify(req));
+        return req['id'];
+    }
+
     _onHandshake(event) {
         console.log('JS client connected');
     }
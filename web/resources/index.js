@@ -42,12 +42,19 @@ const vm = new Vue({
                     case 'playing':
                         this.nowPlaying = obj['msg']
                         break;
+                    case 'now_playing':
+                        this.nowPlaying = obj['msg']['title'] || ''
+                        break;
+                    case 'files_changed':
+                        this.getPlaylist();
+                        break;
                 }
             }
         },
         onOpen(data) {
             console.log('Successfully connected!')
             this.getPlaylist();
+            this.client.sendRequest({'action': 'subscribe'});
         },
         playSound(filename) {
             let req = {
@@ -55,13 +62,13 @@ const vm = new Vue({
                 'user_id': this.userId,
                 'filename': filename
             };
-            this.client.sendMessage(JSON.stringify(req));
+            this.client.sendRequest(req);
         },
         getPlaylist() {
             let req = {
                 'action': 'list'
             };
-            this.client.sendMessage(JSON.stringify(req));
+            this.client.sendRequest(req);
         },
         filterPlaylist() {
             console.log(this.filterText)
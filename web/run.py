@@ -1,17 +1,129 @@
 #!/usr/bin/env python3
 import os
+import gzip
+import json
+import hashlib
 import argparse
+import threading
 
-from flask import Flask
+from flask import Flask, Response, request, send_file, abort
 from flask_cors import CORS
 from waitress import serve
 
+GZIP_MIN_SIZE = 1024
+LISTING_MAX_AGE = 10
+AUDIO_MAX_AGE = 3600
+
 app = Flask(__name__)
 CORS(app)
 
+
+class SoundListing:
+    def __init__(self, sounds_path):
+        self.sounds_path = sounds_path
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._files = {}
+        self._body = b''
+        self._gzip_body = b''
+        self.etag = None
+
+
+    def _refresh(self):
+        dir_mtime = os.stat(self.sounds_path).st_mtime_ns
+
+        if dir_mtime == self._dir_mtime:
+            return
+
+        files = {}
+
+        # Same rules as FileRepo, hidden files are caches and manifests
+        for entry in os.scandir(self.sounds_path):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+
+            name = "".join(entry.name.split('.')[:-1])
+            stat = entry.stat()
+            files[name] = {
+                'name': name,
+                'filename': entry.name,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime
+            }
+
+        body = json.dumps([files[n] for n in sorted(files)]).encode('utf-8')
+
+        self._files = files
+        self._body = body
+        self._gzip_body = gzip.compress(body)
+        self.etag = hashlib.sha1(body).hexdigest()
+        self._dir_mtime = dir_mtime
+
+
+    def get(self):
+        with self._lock:
+            self._refresh()
+            return self.etag, self._body, self._gzip_body
+
+
+    def find(self, name):
+        with self._lock:
+            self._refresh()
+            return self._files.get(name)
+
+
 @app.route('/')
 def index():
     return app.send_static_file('index.html')
 
+
+@app.route('/api/sounds')
+def list_sounds():
+    etag, body, gzip_body = app.config['SOUNDS'].get()
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif len(body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings:
+        response = Response(gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = LISTING_MAX_AGE
+    return response
+
+
+@app.route('/api/sounds/<name>')
+def sound_preview(name):
+    sound = app.config['SOUNDS'].find(name)
+
+    if not sound:
+        abort(404)
+
+    # conditional handles If-None-Match and Range requests, and waitress
+    # streams the file through wsgi.file_wrapper rather than reading it in
+    response = send_file(
+        os.path.join(app.config['SOUNDS'].sounds_path, sound['filename']),
+        conditional=True,
+        max_age=AUDIO_MAX_AGE
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
 if __name__ == "__main__":
-    serve(app, host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser('''The Jeff bot web dashboard''')
+    parser.add_argument('-sounds_path', type=str, help='A mounted directory holding the sound files to list and preview', required=True)
+    parser.add_argument('-port', type=int, help='The port to serve on', default=5000)
+    args = parser.parse_args()
+
+    # Nothing creates this directory for us, an empty one would only serve an
+    # empty listing and 404 every preview
+    if not os.path.isdir(args.sounds_path):
+        parser.error(f'Sound directory {args.sounds_path} does not exist, mount the sound files there')
+
+    app.config['SOUNDS'] = SoundListing(args.sounds_path)
+    serve(app, host='0.0.0.0', port=args.port)